@@ -11,6 +11,12 @@ prep() {
     done
 	cd ..
 	sed -i -e '/^VERSION =/s/^.*$/VERSION = "'$VERSION'"/g' ego
+	index
+}
+
+index() {
+	# pre-build the index of ego modules used by 'ego help' (see python/ego/registry.py):
+	PYTHONPATH=python python3 -m ego.registry .
 }
 
 commit() {
@@ -29,6 +35,9 @@ commit() {
 if [ "$1" = "prep" ]
 then
 	prep
+elif [ "$1" = "index" ]
+then
+	index
 elif [ "$1" = "commit" ]
 then
 	commit
@@ -1,17 +1,100 @@
 #!/usr/bin/python3
 
+import asyncio
+import json
 import subprocess
 import threading
 import sys
+import time
+from contextlib import contextmanager
 from enum import Enum
 from datetime import datetime
 from io import StringIO
 
 
+class Timings(object):
+	"""
+	``Timings`` collects how long things take. Every command run by a ``Task`` is recorded, along with the phase
+	(and kit, if any) that was current when it ran, and phases themselves are timed using the ``phase()`` context
+	manager.
+
+	Records are plain dicts so that they can be sent from a forked child process back to its parent as JSON, using
+	``send()`` in the child and ``receive()`` in the parent.
+	"""
+
+	def __init__(self):
+		self.records = []
+		self.labels = {"phase": None, "kit": None}
+
+	@contextmanager
+	def phase(self, phase, kit=None):
+		outer = self.labels
+		self.labels = {"phase": phase, "kit": kit if kit is not None else outer["kit"]}
+		started = time.time()
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.labels = outer
+			self.records.append(
+				{
+					"type": "phase",
+					"phase": phase,
+					"kit": kit,
+					"start": started,
+					"duration": time.monotonic() - start,
+				}
+			)
+
+	def task_complete(self, task):
+		self.records.append(
+			{
+				"type": "command",
+				"phase": self.labels["phase"],
+				"kit": self.labels["kit"],
+				"command": " ".join(task.cmdlist),
+				"start": task.start_on.timestamp(),
+				"duration": (task.complete_on - task.start_on).total_seconds(),
+				"returncode": task.returncode,
+			}
+		)
+
+	def mark(self):
+		"""Returns a marker to pass to ``send()`` so that a child only sends records created after a fork."""
+		return len(self.records)
+
+	def send(self, fd, mark=0):
+		with open(fd, "w") as f:
+			for record in self.records[mark:]:
+				f.write(json.dumps(record) + "\n")
+
+	def receive(self, fd):
+		with open(fd, "r") as f:
+			self.receive_lines(f)
+
+	def receive_lines(self, lines):
+		for line in lines:
+			try:
+				self.records.append(json.loads(line))
+			except ValueError:
+				pass
+
+	def phases(self):
+		return [r for r in self.records if r["type"] == "phase"]
+
+	def commands(self):
+		return [r for r in self.records if r["type"] == "command"]
+
+
+# All Tasks record their timings here:
+timings = Timings()
+
+
 class Task(object):
-	def __init__(self, cmdlist, abortOnError=True):
+	def __init__(self, cmdlist, abortOnError=True, timeout=None):
 		self.cmdlist = cmdlist
 		self.abortOnError = abortOnError
+		self.timeout = timeout
 		self.running = False
 		self.complete_on = None
 		self.start_on = None
@@ -25,6 +108,7 @@ class Task(object):
 		self.returncode = runner.execute(self.cmdlist)
 		self.running = False
 		self.complete_on = datetime.now()
+		timings.task_complete(self)
 		if self.abortOnError is True and self.returncode != 0:
 			self.failEvent()
 			return False
@@ -165,6 +249,178 @@ def run_statusoutput(command):
 	return tr.returncode, outf.getvalue()
 
 
+class TaskResult(object):
+	"""The outcome of a single ``Task`` run by an ``AsyncTaskRunner``."""
+
+	def __init__(self, task):
+		self.task = task
+		self.returncode = None
+		self.start_on = None
+		self.complete_on = None
+		self.stdout = []
+		self.stderr = []
+		self.timed_out = False
+		self.cancelled = False
+
+	@property
+	def cmdlist(self):
+		return self.task.cmdlist
+
+	@property
+	def duration(self):
+		if self.start_on is None or self.complete_on is None:
+			return None
+		return (self.complete_on - self.start_on).total_seconds()
+
+	@property
+	def output(self):
+		return "".join(self.stdout)
+
+	@property
+	def success(self):
+		return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+	def __repr__(self):
+		return "<TaskResult %r returncode=%s duration=%s>" % (" ".join(self.cmdlist), self.returncode, self.duration)
+
+
+class AsyncTaskRunner(object):
+	"""
+	``AsyncTaskRunner`` runs many chains of ``Task`` objects concurrently using asyncio, with at most ``jobs`` commands
+	running at any one time. A chain is anything that iterates over Tasks -- a ``TaskList``, or a ``Task`` linked to
+	others using ``nextTask``. Tasks within a chain run in order, and a failing Task with ``abortOnError`` set stops its
+	chain, just like ``TaskRunner``.
+
+	The stdout and stderr of each command are captured line by line into its ``TaskResult``. If ``on_line`` is
+	specified, it is also called as ``on_line(task, stream, line)`` for each line as it arrives, where ``stream`` is
+	"stdout" or "stderr".
+
+	A command that runs for longer than its timeout (``Task.timeout``, or the ``timeout`` of the runner) is terminated
+	and its result is marked as ``timed_out``. If the coroutine running a chain is cancelled, the command it is running
+	is terminated as well.
+
+	Example::
+
+		runner = AsyncTaskRunner(jobs=4, timeout=600)
+		results = runner.run([Task(["git", "-C", path, "fetch"]) for path in paths])
+	"""
+
+	# seconds to wait after SIGTERM before resorting to SIGKILL:
+	kill_grace = 2.0
+
+	def __init__(self, jobs=4, timeout=None, on_line=None):
+		self.jobs = max(1, jobs)
+		self.timeout = timeout
+		self.on_line = on_line
+		self._semaphore = None
+
+	@property
+	def semaphore(self):
+		# a semaphore belongs to the event loop it is first used in, so each run() -- which has its own loop -- gets
+		# its own:
+		loop = asyncio.get_running_loop()
+		if self._semaphore is None or self._semaphore[0] is not loop:
+			self._semaphore = (loop, asyncio.Semaphore(self.jobs))
+		return self._semaphore[1]
+
+	async def _read_lines(self, task, stream, name, lines):
+		while True:
+			line = await stream.readline()
+			if not line:
+				break
+			line = line.decode(errors="replace")
+			lines.append(line)
+			if self.on_line is not None:
+				self.on_line(task, name, line)
+
+	async def _terminate(self, proc):
+		if proc.returncode is not None:
+			return
+		try:
+			proc.terminate()
+			await asyncio.wait_for(proc.wait(), self.kill_grace)
+		except ProcessLookupError:
+			pass
+		except asyncio.TimeoutError:
+			proc.kill()
+			await proc.wait()
+
+	async def _communicate(self, task, result, timeout):
+		try:
+			proc = await asyncio.create_subprocess_exec(
+				*task.cmdlist, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+			)
+		except OSError as e:
+			result.stderr.append(str(e) + "\n")
+			result.returncode = 127
+			return
+		readers = asyncio.gather(
+			self._read_lines(task, proc.stdout, "stdout", result.stdout),
+			self._read_lines(task, proc.stderr, "stderr", result.stderr),
+			proc.wait(),
+		)
+		try:
+			await asyncio.wait_for(asyncio.shield(readers), timeout)
+		except asyncio.TimeoutError:
+			result.timed_out = True
+			await self._terminate(proc)
+			try:
+				# collect any remaining output, unless something the command started is still holding its pipes open:
+				await asyncio.wait_for(readers, self.kill_grace)
+			except asyncio.TimeoutError:
+				pass
+		except asyncio.CancelledError:
+			result.cancelled = True
+			readers.cancel()
+			await self._terminate(proc)
+			raise
+		finally:
+			result.returncode = proc.returncode
+
+	async def execute(self, task):
+		"""Runs a single Task, once a slot is free, and returns its ``TaskResult``."""
+		result = TaskResult(task)
+		async with self.semaphore:
+			task.startEvent()
+			task.running = True
+			task.start_on = result.start_on = datetime.now()
+			try:
+				await self._communicate(task, result, task.timeout if task.timeout is not None else self.timeout)
+			finally:
+				task.running = False
+				task.returncode = result.returncode
+				task.complete_on = result.complete_on = datetime.now()
+				timings.task_complete(task)
+		if result.success or task.abortOnError is not True:
+			task.completeEvent()
+		else:
+			task.failEvent()
+		return result
+
+	async def run_chain(self, chain):
+		"""Runs the Tasks of a chain in order. Returns a list of the ``TaskResult`` of each Task that was started."""
+		results = []
+		for task in chain:
+			result = await self.execute(task)
+			results.append(result)
+			if task.abortOnError is True and not result.success:
+				break
+		return results
+
+	async def run_all(self, chains):
+		return await asyncio.gather(*[self.run_chain(chain) for chain in chains])
+
+	def run(self, chains):
+		"""
+		Runs all ``chains`` concurrently, and returns a list containing, for each chain, the list of ``TaskResult``
+		objects of the Tasks that were started.
+		"""
+		try:
+			return asyncio.run(self.run_all(chains))
+		finally:
+			self._semaphore = None
+
+
 class ThreadedTaskRunner(TaskRunner, threading.Thread):
 	def __init__(self, tasks, outfile=None, **kwargs):
 		TaskRunner.__init__(self, tasks, outfile=outfile, **kwargs)
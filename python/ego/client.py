@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import json
+import os
+import socket
+import sys
+
+# This module is imported by the ego command before anything else, so it should only import what it needs to talk to
+# the daemon.
+
+DEFAULT_SOCKET = "/run/ego/ego.sock"
+PROTOCOL_VERSION = 1
+
+
+def daemon_socket_path(settings):
+	"""Returns the path of the ego daemon's socket, given the (``ConfigParser``) settings from ``ego.conf``."""
+	try:
+		return settings["global"]["daemon_socket"]
+	except KeyError:
+		return DEFAULT_SOCKET
+
+
+def read_message(sock, buf=b""):
+	"""Reads one JSON message (a line) from ``sock``. Returns it and any data after it, or (None, data) at EOF."""
+	while b"\n" not in buf:
+		chunk = sock.recv(65536)
+		if not chunk:
+			return None, buf
+		buf += chunk
+	line, buf = buf.split(b"\n", 1)
+	return json.loads(line.decode("utf-8")), buf
+
+
+def run_in_daemon(socket_path, argv, root_path, settings_path, install_path, version):
+	"""
+	Asks the ego daemon listening on ``socket_path`` to run the ego command ``argv``. Our stdin, stdout and stderr are
+	passed to the daemon, so that the command reads and writes them directly. Returns the exit status of the command,
+	or None if there is no daemon, or if it can't run the command -- in which case it should be run locally.
+	"""
+	# passing file descriptors with socket.send_fds() requires Python 3.9:
+	if not hasattr(socket, "send_fds") or not os.path.exists(socket_path):
+		return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		try:
+			sock.connect(socket_path)
+			request = {
+				"version": PROTOCOL_VERSION,
+				"argv": argv,
+				"cwd": os.getcwd(),
+				"env": dict(os.environ),
+				"root_path": root_path,
+				"settings_path": settings_path,
+				"install_path": install_path,
+				"ego_version": version,
+			}
+			data = json.dumps(request).encode("utf-8") + b"\n"
+			sent = socket.send_fds(sock, [data], [0, 1, 2])
+			sock.sendall(data[sent:])
+		except OSError:
+			return None
+		try:
+			reply, buf = read_message(sock)
+		except KeyboardInterrupt:
+			# closing the connection makes the daemon interrupt the command:
+			return 130
+		if reply is None:
+			sys.stderr.write("ego: lost connection to the ego daemon.\n")
+			return 1
+		if "refused" in reply:
+			return None
+		return reply["status"]
+	finally:
+		sock.close()
+
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+from collections import OrderedDict
+
+from ego.config import atomic_write
+from ego.output import Output
+
+
+class CompletionIndex(object):
+	"""
+	``CompletionIndex`` writes the words that shell completion offers for ego commands to a flat text file, so that
+	completion scripts can read them without starting ego. Each line is a key and a word, separated by a space::
+
+	  module profile
+	  action/profile mix-ins
+	  kit core-kit
+	  branch/core-kit 1.4-prime
+	  profile/flavor desktop
+	  profile/subarch/x86-64bit intel64-haswell
+	  current/arch x86-64bit
+
+	``profile/<type>`` lists the profiles of each type that don't depend on the arch. Subarches and arch-specific
+	mix-ins are listed as ``profile/subarch/<arch>`` and ``profile/mix-ins/<arch>``. ``current/arch`` is the arch
+	currently set in the system profile, if known.
+
+	The index is regenerated by ``ego sync`` and whenever ``epro`` changes profiles.
+	"""
+
+	def __init__(self, config, catalog=None, arch=None):
+		self.config = config
+		self.catalog = catalog
+		self.arch = arch
+
+	def module_entries(self):
+		from ego.module import EgoModule
+
+		for name in self.config.modules.names():
+			try:
+				mod = EgoModule.load_ego_module(name, self.config)
+				# Don't run the constructor, as setup() of some modules does more than just looking at options:
+				module = mod.Module.__new__(mod.Module)
+				module.name = name
+				module.config = self.config
+				parser = argparse.ArgumentParser()
+				module.add_arguments(parser)
+			except Exception as e:
+				Output.debug("Unable to list actions of %s ego module: %s" % (name, e))
+				continue
+			yield "module", name
+			for action in parser._actions:
+				if isinstance(action, argparse._SubParsersAction):
+					for subcommand in action.choices:
+						yield "action/" + name, subcommand
+
+	def kit_entries(self):
+		for kit, branches in self.config.kit_sha1_metadata.items():
+			yield "kit", kit
+			for branch in branches:
+				yield "branch/" + kit, branch
+
+	def profile_entries(self):
+		from ego.profile import MetaProfileCatalog, ProfileType, all_funtoo_repos
+
+		if self.catalog is not None:
+			funtoo_repos = self.catalog.funtoo_repos
+		else:
+			try:
+				funtoo_repos = all_funtoo_repos(self.config)
+			except OSError:
+				# no repos.conf yet:
+				return
+		# A catalog of our own, as list() uses the arch of the catalog if none is given:
+		catalog = MetaProfileCatalog(self.config, funtoo_repos)
+		general = {}
+		for profile_type in ProfileType.valid():
+			general[profile_type] = list(OrderedDict.fromkeys(catalog.list(profile_type)))
+			for name in general[profile_type]:
+				yield "profile/%s" % profile_type, name
+		for arch in general[ProfileType.ARCH]:
+			for profile_type in [ProfileType.SUBARCH, ProfileType.MIX_IN]:
+				for name in OrderedDict.fromkeys(catalog.list(profile_type, arch=arch)):
+					if name not in general[profile_type]:
+						yield "profile/%s/%s" % (profile_type, arch), name
+		if self.arch is not None:
+			yield "current/arch", self.arch
+
+	def entries(self):
+		for entry in self.module_entries():
+			yield entry
+		for entry in self.kit_entries():
+			yield entry
+		for entry in self.profile_entries():
+			yield entry
+
+	def write(self):
+		"""Writes the index to ``config.completion_index``. Returns False if it couldn't be written."""
+		try:
+			content = "".join("%s %s\n" % entry for entry in self.entries())
+			os.makedirs(os.path.dirname(self.config.completion_index), exist_ok=True)
+			atomic_write(self.config.completion_index, content)
+		except OSError as e:
+			Output.debug("Unable to write completion index: %s" % e)
+			return False
+		return True
+
+
+# vim: ts=4 sw=4 noet
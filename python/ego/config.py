@@ -1,12 +1,17 @@
 #!/usr/bin/python3
 
-import glob
+import io
 import json
+import marshal
 import os
+import stat
 import sys
 from collections import OrderedDict
-from configparser import InterpolationError
-from pathlib import Path
+from configparser import ConfigParser, InterpolationError
+
+from ego.client import DEFAULT_SOCKET
+from ego.registry import ModuleInfoMap, ModuleRegistry
+from git_reader import GitReader
 
 
 def join_path(x, y):
@@ -14,6 +19,289 @@ def join_path(x, y):
 	return os.path.join(x, y.lstrip("/"))
 
 
+def atomic_write(path, content, mode=0o644):
+	# tempfile is imported here, as it is slow to import and most ego commands never write anything:
+	import tempfile
+
+	# write to a temporary file in the same directory, then rename it into place, so that readers never see a
+	# partially-written file:
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".")
+	try:
+		with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as f:
+			f.write(content)
+			f.flush()
+			os.fsync(f.fileno())
+		os.chmod(tmp_path, mode)
+		os.replace(tmp_path, path)
+	except BaseException:
+		try:
+			os.unlink(tmp_path)
+		except OSError:
+			pass
+		raise
+
+
+def is_trusted(st):
+	"""
+	Returns True if the file or directory that ``st`` (from ``os.stat()``) describes can only have been written by us or
+	root. Caches holding data that is used as-is, without parsing and checking it, are only read if this is the case.
+	"""
+	return st.st_uid in (os.geteuid(), 0) and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def is_trusted_dir(path):
+	try:
+		return is_trusted(os.stat(path))
+	except OSError:
+		return False
+
+
+def _render_settings(settings):
+	out = io.StringIO()
+	settings.write(out)
+	return out.getvalue()
+
+
+class MetadataCache(object):
+	"""
+	Process-wide cache of parsed JSON metadata files. Entries are keyed by path and validated against the file's mtime,
+	size and inode on each access, so a file that changes on disk -- for example, when ``ego sync`` updates meta-repo --
+	is parsed again, while an unchanged file is only parsed once.
+	"""
+
+	def __init__(self):
+		self.entries = {}
+		self.hits = 0
+		self.misses = 0
+
+	def load(self, path):
+		"""Returns the parsed contents of the JSON file at ``path``. Raises OSError if it can't be read."""
+		st = os.stat(path)
+		sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+		entry = self.entries.get(path)
+		if entry is not None and entry[0] == sig:
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		with open(path, "r") as f:
+			data = json.loads(f.read(), object_pairs_hook=OrderedDict)
+		self.entries[path] = (sig, data)
+		return data
+
+	def prime(self, path, sig, data):
+		"""Adds already-parsed ``data`` for ``path``, valid as long as the file's (mtime_ns, size, inode) is ``sig``."""
+		self.entries[path] = (tuple(sig), data)
+
+	def clear(self):
+		self.entries = {}
+
+	def __str__(self):
+		return "%s hits, %s misses" % (self.hits, self.misses)
+
+
+metadata_cache = MetadataCache()
+
+
+def _plain(data):
+	# marshal only handles built-in types, so turn OrderedDicts into (equally ordered) dicts:
+	if isinstance(data, dict):
+		return {k: _plain(v) for k, v in data.items()}
+	elif isinstance(data, list):
+		return [_plain(v) for v in data]
+	return data
+
+
+class MetadataSnapshot(object):
+	"""
+	A precompiled copy of meta-repo's metadata JSON files, stored using ``marshal`` so that it loads much faster than
+	parsing the JSON. ``ego sync`` writes it after updating meta-repo. The snapshot records the meta-repo commit it was
+	made from and the mtime, size and inode of each file, and is only used while all of these still match.
+	"""
+
+	format_version = 1
+	metadata_files = ["kit-info", "kit-sha1", "version"]
+
+	def __init__(self, path, meta_repo_root):
+		self.path = path
+		self.meta_repo_root = meta_repo_root
+
+	def metadata_path(self, fn):
+		return os.path.join(self.meta_repo_root, "metadata", "%s.json" % fn)
+
+	def write(self):
+		snapshot = {
+			"format": self.format_version,
+			"python": tuple(sys.version_info[:2]),
+			"meta_sha1": GitReader(self.meta_repo_root).head(),
+			"files": {},
+		}
+		for fn in self.metadata_files:
+			path = self.metadata_path(fn)
+			try:
+				st = os.stat(path)
+				data = metadata_cache.load(path)
+			except OSError:
+				snapshot["files"][fn] = None
+				continue
+			snapshot["files"][fn] = ((st.st_mtime_ns, st.st_size, st.st_ino), _plain(data))
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		atomic_write(self.path, marshal.dumps(snapshot))
+
+	def load(self):
+		"""
+		Adds the contents of the snapshot to ``metadata_cache`` if the snapshot is still valid. Returns True if it was.
+		"""
+		try:
+			with open(self.path, "rb") as f:
+				snapshot = marshal.load(f)
+		except (OSError, EOFError, ValueError, TypeError):
+			return False
+		if not isinstance(snapshot, dict) or snapshot.get("format") != self.format_version:
+			return False
+		# the marshal format is specific to the Python version:
+		if snapshot.get("python") != tuple(sys.version_info[:2]):
+			return False
+		if snapshot["meta_sha1"] is None or snapshot["meta_sha1"] != GitReader(self.meta_repo_root).head():
+			return False
+		for fn in self.metadata_files:
+			entry = snapshot["files"].get(fn)
+			try:
+				st = os.stat(self.metadata_path(fn))
+			except OSError:
+				if entry is None:
+					continue
+				return False
+			if entry is None or tuple(entry[0]) != (st.st_mtime_ns, st.st_size, st.st_ino):
+				return False
+		for fn in self.metadata_files:
+			entry = snapshot["files"][fn]
+			if entry is not None:
+				metadata_cache.prime(self.metadata_path(fn), entry[0], entry[1])
+		return True
+
+
+class ResolvedKit(object):
+	"""
+	The resolved configuration of a single kit: the branch to use (as set in ego.conf, or the default branch), the
+	default branch of the release, the stability of the branch (``None`` if the branch isn't known to the metadata),
+	the kit type (``AUTO`` or ``INDY``) and the SHA1 and clone depth that kit-sha1.json specifies for the branch
+	(``None`` if the branch isn't listed there).
+	"""
+
+	__slots__ = ["name", "branch", "default_branch", "stability", "type", "sha1", "depth"]
+
+	def __init__(self, name, branch, default_branch, stability, type, sha1, depth):
+		self.name = name
+		self.branch = branch
+		self.default_branch = default_branch
+		self.stability = stability
+		self.type = type
+		self.sha1 = sha1
+		self.depth = depth
+
+	@property
+	def missing(self):
+		return self.stability is None
+
+	@property
+	def deprecated(self):
+		return self.stability in [None, "deprecated"]
+
+	def __repr__(self):
+		return "ResolvedKit(%s)" % ", ".join("%s=%r" % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+class ResolvedKitTable(object):
+	"""
+	The configuration of all kits, resolved once from the ``[kits]`` section of ego.conf and meta-repo's kit-info and
+	kit-sha1 metadata. Iterating over the table yields a ``ResolvedKit`` for each kit of the release, in kit order;
+	other kits (such as overlays) are resolved when looked up by name.
+	"""
+
+	def __init__(self, kit_settings, kit_info, kit_sha1, release, metadata_version=1, kits_depth=2):
+		self.kit_settings = dict(kit_settings)
+		self.kit_info = kit_info
+		self.kit_sha1 = kit_sha1
+		self.release = release
+		self.metadata_version = metadata_version
+		self.kits_depth = int(kits_depth)
+		self.records = {}
+		kit_order = kit_info.get("kit_order", [])
+		if isinstance(kit_order, dict):
+			if "%s-release" % release not in kit_order:
+				raise ValueError("release %s is not defined in meta-repo's kit-info metadata" % release)
+			kit_order = kit_order["%s-release" % release]
+		self.kit_order = list(kit_order)
+		for kit in self.kit_order:
+			self[kit]
+
+	def __iter__(self):
+		for kit in self.kit_order:
+			yield self[kit]
+
+	def __getitem__(self, kit):
+		record = self.records.get(kit)
+		if record is None:
+			record = self.records[kit] = self.resolve(kit)
+		return record
+
+	def release_default_branch(self, kit):
+		release_defs = self.kit_info.get("release_defs", {})
+		try:
+			if self.metadata_version >= 10:
+				return release_defs[kit][0]
+			else:
+				return release_defs[self.release][kit][0]
+		except KeyError:
+			return None
+
+	def branch_stability(self, kit, branch):
+		"""Returns the stability of ``branch`` of ``kit``, or None if the branch is missing from the metadata."""
+		try:
+			return self.kit_info["kit_settings"][kit]["stability"][branch]
+		except KeyError:
+			return None
+
+	def desired_sha1(self, kit, branch):
+		"""
+		Returns the SHA1 and clone depth that kit-sha1.json specifies for ``branch`` of ``kit``. Raises KeyError if the
+		branch is not listed.
+		"""
+		sha1_data = self.kit_sha1[kit][branch]
+		if isinstance(sha1_data, str):
+			# old format, a plain SHA1:
+			return sha1_data, self.kits_depth if self.kits_depth != 0 else 1
+		return sha1_data["sha1"], sha1_data["depth"] if self.kits_depth != 0 else 1
+
+	def resolve(self, kit):
+		branch = self.kit_settings.get(kit)
+		default_branch = None
+		try:
+			if self.release is not None:
+				default_branch = self.release_default_branch(kit)
+			if default_branch is None:
+				default_branch = self.kit_info["kit_settings"][kit]["default"]
+			if branch is None:
+				branch = default_branch
+		except KeyError:
+			pass
+		try:
+			kit_type = self.kit_info["kit_settings"][kit]["type"]
+		except KeyError:
+			kit_type = "AUTO"
+		try:
+			sha1, depth = self.desired_sha1(kit, branch)
+		except KeyError:
+			sha1, depth = None, None
+		return ResolvedKit(kit, branch, default_branch, self.branch_stability(kit, branch), kit_type, sha1, depth)
+
+	def kit_names_in_release(self):
+		if self.metadata_version >= 10:
+			return [kit for kit in self.kit_info["release_defs"].keys() if self[kit].branch != "skip"]
+		else:
+			return self.kit_info["release_defs"][self.release].keys()
+
+
 class EgoConfig(object):
 	def get_setting(self, section, key, default=None):
 		if section in self.settings and key in self.settings[section]:
@@ -34,14 +322,40 @@ class EgoConfig(object):
 			return my_meta["version"]
 
 	def set_setting(self, section, key, value):
-		if section not in self.settings:
-			self.settings.add_section(section)
-		self.settings.set(section, key, value)
-		self._save()
+		self.set_settings([(section, key, value)])
+
+	def set_settings(self, changes, dry_run=False):
+		"""
+		Applies a list of ``(section, key, value)`` changes and writes ego.conf once, atomically. With ``dry_run``,
+		neither the settings nor ego.conf are changed. Returns the old and the new contents of ego.conf.
+		"""
+		try:
+			with open(self.settings_path, "r") as f:
+				old_contents = f.read()
+		except FileNotFoundError:
+			old_contents = ""
+		# apply the changes to a copy first, so that a dry run leaves the settings alone:
+		new_settings = ConfigParser(interpolation=None)
+		new_settings.read_string(_render_settings(self.settings))
+		for settings in [new_settings] if dry_run else [new_settings, self.settings]:
+			for section, key, value in changes:
+				if section not in settings:
+					settings.add_section(section)
+				settings.set(section, key, value)
+		new_contents = _render_settings(new_settings)
+		if not dry_run:
+			self._kit_table = None
+			self._save(new_contents)
+		return old_contents, new_contents
 
-	def _save(self):
-		with open(self.settings_path, "w") as outfile:
-			self.settings.write(outfile)
+	def _save(self, contents=None):
+		if contents is None:
+			contents = _render_settings(self.settings)
+		try:
+			mode = os.stat(self.settings_path).st_mode & 0o7777
+		except FileNotFoundError:
+			mode = 0o644
+		atomic_write(self.settings_path, contents, mode=mode)
 
 	def metadata_exists(self):
 		if os.path.exists(self.meta_repo_root) and os.path.exists(self.meta_repo_root + "/metadata"):
@@ -49,15 +363,23 @@ class EgoConfig(object):
 		else:
 			return False
 
+	@property
+	def completion_index(self):
+		return os.path.join(self.cache_dir, "completion")
+
+	@property
+	def metadata_snapshot(self):
+		return MetadataSnapshot(os.path.join(self.cache_dir, "metadata.marshal"), self.meta_repo_root)
+
 	def load_kit_metadata(self, fn):
-		if not hasattr(self, "_kit_%s" % fn):
-			path = Path(self.meta_repo_root) / "metadata" / ("%s.json" % fn)
-			try:
-				with path.open() as f:
-					return json.loads(f.read(), object_pairs_hook=OrderedDict)
-			except OSError:
-				return {}
-		return getattr(self, "_kit_%s" % fn)
+		if not self._snapshot_checked:
+			self._snapshot_checked = True
+			self.metadata_snapshot.load()
+		path = os.path.join(self.meta_repo_root, "metadata", "%s.json" % fn)
+		try:
+			return metadata_cache.load(path)
+		except OSError:
+			return {}
 
 	@property
 	def kit_info_metadata(self):
@@ -81,17 +403,30 @@ class EgoConfig(object):
 		except KeyError:
 			return self.default_release
 
+	@property
+	def kit_table(self):
+		"""
+		The ``ResolvedKitTable`` of the current ego.conf and metadata. It is resolved once and shared by all callers, and
+		resolved again only when the metadata changes on disk (as when ``ego sync`` updates meta-repo) or a setting is
+		changed.
+		"""
+		kit_info = self.kit_info_metadata
+		kit_sha1 = self.kit_sha1_metadata
+		table = self._kit_table
+		if table is None or table.kit_info is not kit_info or table.kit_sha1 is not kit_sha1:
+			kit_settings = self.settings["kits"] if "kits" in self.settings else {}
+			try:
+				table = self._kit_table = ResolvedKitTable(
+					kit_settings, kit_info, kit_sha1, self.release, metadata_version=self.metadata_version, kits_depth=self.kits_depth
+				)
+			except ValueError as e:
+				sys.stderr.write("Unable to use the kits of your ego.conf: %s.\n" % e)
+				sys.exit(1)
+		return table
+
 	@property
 	def all_kit_names_in_release(self):
-		if self.metadata_version >= 10:
-			kits = []
-			for kit_name in self.kit_info_metadata["release_defs"].keys():
-				branch, default_branch = self.get_configured_kit(kit_name)
-				if branch != "skip":
-					kits.append(kit_name)
-			return kits
-		else:
-			return self.kit_info_metadata["release_defs"][self.release].keys()
+		return self.kit_table.kit_names_in_release()
 
 	def get_kit_version_of_release(self, release, kit):
 		if self.metadata_version >= 10:
@@ -106,46 +441,18 @@ class EgoConfig(object):
 				return None
 
 	def kit_branch_is_missing(self, kit, branch):
-		try:
-			a = self.kit_info_metadata["kit_settings"][kit]["stability"][branch]
-			return False
-		except KeyError:
-			return True
-		return True
+		return self.kit_table.branch_stability(kit, branch) is None
 
 	def kit_branch_is_deprecated(self, kit, branch):
-		try:
-			return self.kit_info_metadata["kit_settings"][kit]["stability"][branch] == "deprecated"
-		except KeyError:
-			return True
-		return True
+		return self.kit_table.branch_stability(kit, branch) in [None, "deprecated"]
 
 	def kit_branch_stability(self, kit, branch):
-		try:
-			return self.kit_info_metadata["kit_settings"][kit]["stability"][branch]
-		except KeyError:
-			pass
-		return "deprecated"
+		stability = self.kit_table.branch_stability(kit, branch)
+		return stability if stability is not None else "deprecated"
 
 	def get_configured_kit(self, kit):
-		if "kits" in self.settings and kit in self.settings["kits"]:
-			kit_branch = self.settings["kits"][kit]
-		else:
-			kit_branch = None
-
-		release = self.release
-
-		default_kit_branch = None
-		try:
-			if release is not None:
-				default_kit_branch = self.get_kit_version_of_release(self.release, kit)
-			if default_kit_branch is None:
-				default_kit_branch = self.kit_info_metadata["kit_settings"][kit]["default"]
-			if kit_branch is None:
-				kit_branch = default_kit_branch
-		except KeyError:
-			pass
-		return kit_branch, default_kit_branch
+		record = self.kit_table[kit]
+		return record.branch, record.default_branch
 
 	def __init__(self, settings, settings_path, root_path="/", install_path="/usr/share/ego"):
 
@@ -155,27 +462,20 @@ class EgoConfig(object):
 		self.ego_dir = install_path
 		self.ego_mods_dir = "%s/modules" % self.ego_dir
 		self.ego_mods_info_dir = "%s/modules-info" % self.ego_dir
-		self.ego_mods = []
-		self.ego_mods_info = {}
-
-		if os.path.isdir(self.ego_mods_dir):
-			for match in glob.glob(self.ego_mods_dir + "/*.ego"):
-				self.ego_mods.append(match.split("/")[-1][:-4])
-		for mod in self.ego_mods:
-			inf_path = self.ego_mods_info_dir + "/" + mod + ".json"
-			if os.path.exists(inf_path):
-				with open(inf_path, "r") as inf:
-					self.ego_mods_info[mod] = json.loads(inf.read())
-			else:
-				self.ego_mods_info[mod] = {}
+		# modules and their metadata are only looked at when needed:
+		self.modules = ModuleRegistry(self.ego_dir)
+		self.ego_mods_info = ModuleInfoMap(self.modules)
 		self.settings = settings
 		self.settings_path = settings_path
+		self._snapshot_checked = False
+		self._kit_table = None
+		# (catalog, tree) loaded in advance by the ego daemon, used by getProfileCatalogAndTree():
+		self.warm_profile = None
 
 		self.meta_repo_root = self.get_setting("global", "meta_repo_path", join_path(self.root_path, "/var/git/meta-repo"))
-		if "EGO_SYNC_BASE_URL" in os.environ:
-			self.sync_base_url = os.environ["EGO_SYNC_BASE_URL"]
-		else:
-			self.sync_base_url = self.get_setting("global", "sync_base_url", "https://github.com/funtoo/{repo}")
+		self.cache_dir = self.get_setting("global", "cache_dir", join_path(self.root_path, "/var/cache/ego"))
+		self.daemon_socket = self.get_setting("global", "daemon_socket", DEFAULT_SOCKET)
+		self.read_environment()
 		if self.release in ["1.0", "1.2"]:
 			self.meta_repo_branch = "master"
 		elif self.release == "1.4":
@@ -197,8 +497,38 @@ class EgoConfig(object):
 			self.unprefixed_kits_root = "/" + self.unprefixed_kits_root
 		self.sync_user = self.get_setting("global", "sync_user", "portage")
 
-		self.kits_depth = self.get_setting("global", "kits_depth", 2)
+		try:
+			self.kits_depth = int(self.get_setting("global", "kits_depth", 2))
+		except ValueError:
+			sys.stderr.write("There is an error in your ego.conf: kits_depth must be an integer.\n")
+			sys.exit(1)
+
+		self.shared_objects = self.get_setting("global", "shared_objects", "no").lower() in ["yes", "true", "on", "1"]
+
+		try:
+			self.sync_jobs = int(self.get_setting("global", "sync_jobs", 1))
+		except ValueError:
+			sys.stderr.write("There is an error in your ego.conf: sync_jobs must be an integer.\n")
+			sys.exit(1)
+
+	def read_environment(self):
+		"""
+		Sets the settings that can be overridden by environment variables. The ego daemon calls this again after switching
+		to the environment of the client it runs a command for.
+		"""
+		if "EGO_SYNC_BASE_URL" in os.environ:
+			self.sync_base_url = os.environ["EGO_SYNC_BASE_URL"]
+		else:
+			self.sync_base_url = self.get_setting("global", "sync_base_url", "https://github.com/funtoo/{repo}")
+
+	@property
+	def shared_objects_path(self):
+		# Lives inside meta-repo's .git directory so that it is never touched by 'git clean' of meta-repo:
+		return self.get_setting("global", "shared_objects_path", os.path.join(self.meta_repo_root, ".git/ego-shared.git"))
+
+	@property
+	def ego_mods(self):
+		return self.modules.names()
 
 	def available_modules(self):
-		for x in self.ego_mods:
-			yield x, self.ego_mods_info[x]
+		return self.modules.available()
@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+import configparser
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+
+from ego.client import PROTOCOL_VERSION, read_message
+from ego.config import EgoConfig, MetadataSnapshot, join_path
+from ego.module import EgoModule, dispatch
+from ego.output import Output, setup_terminal
+
+
+class EgoServer(object):
+	"""
+	``EgoServer`` runs ego commands on behalf of ``ego`` clients connecting to a UNIX socket. It keeps an ``EgoConfig``,
+	the compiled ego modules, kit metadata and the profile tree loaded, and forks a child process for each command, so
+	that commands start with all of these ready. Before each command, the files they were loaded from are checked, and
+	everything is reloaded if any of them changed. Commands from another ego installation or version are refused, and
+	so run by the client itself.
+
+	The client passes its stdin, stdout and stderr along with the command (``SCM_RIGHTS``), so the command reads and
+	writes them directly. The child process switches to the client's user (``SO_PEERCRED``), working directory and
+	environment before running the command. Commands that may change the system are run one at a time, by holding an
+	exclusive ``flock()`` on a lock file next to the socket while they run.
+	"""
+
+	def __init__(self, config, socket_path, version=None):
+		self.config = config
+		self.socket_path = socket_path
+		self.lock_path = socket_path + ".lock"
+		self.version = version
+		self.signature = None
+		# ego's own code is imported once, so the daemon can't pick up changes to it. It refuses to run commands if it
+		# changed after the daemon started:
+		self.code_signature = None
+		# pid of each command's process -> connection to its client:
+		self.children = {}
+		self.watched = set()
+		self.listener = None
+		self.running = False
+
+	def watched_files(self):
+		config = self.config
+		paths = [config.settings_path, join_path(config.root_path, "/etc/portage/make.profile/parent")]
+		paths += [os.path.join(config.meta_repo_root, "metadata", "%s.json" % fn) for fn in MetadataSnapshot.metadata_files]
+		for repos_conf in sorted({config.repos_conf_path, join_path(config.root_path, "/etc/portage/repos.conf")}):
+			paths.append(repos_conf)
+			try:
+				paths += sorted(os.path.join(repos_conf, fn) for fn in os.listdir(repos_conf))
+			except OSError:
+				pass
+		# ego modules and their metadata are reloaded when they change:
+		for directory, suffix in [(config.modules.mods_dir, ".ego"), (config.modules.info_dir, ".json")]:
+			paths.append(directory)
+			paths += self.list_files(directory, suffix)
+		return paths
+
+	def code_files(self):
+		directory = os.path.join(self.config.ego_dir, "python/ego")
+		return [directory] + self.list_files(directory, ".py")
+
+	@staticmethod
+	def list_files(directory, suffix):
+		try:
+			return sorted(os.path.join(directory, fn) for fn in os.listdir(directory) if fn.endswith(suffix))
+		except OSError:
+			return []
+
+	@staticmethod
+	def file_signature(paths):
+		signature = []
+		for path in paths:
+			try:
+				st = os.stat(path)
+				signature.append((path, st.st_mtime_ns, st.st_size, st.st_ino))
+			except OSError:
+				signature.append((path, None))
+		return signature
+
+	def current_signature(self):
+		return self.file_signature(self.watched_files())
+
+	def load(self):
+		old = self.config
+		settings = configparser.ConfigParser()
+		settings.read(old.settings_path)
+		config = self.config = EgoConfig(settings, old.settings_path, root_path=old.root_path, install_path=old.ego_dir)
+		for fn in MetadataSnapshot.metadata_files:
+			config.load_kit_metadata(fn)
+		for name in config.modules.names():
+			try:
+				EgoModule.load_ego_module(name, config)
+			except Exception as e:
+				Output.debug("Unable to preload %s ego module: %s" % (name, e))
+		if config.metadata_exists():
+			from ego.profile import getProfileCatalogAndTree
+
+			try:
+				config.warm_profile = getProfileCatalogAndTree(config)
+			except Exception as e:
+				Output.debug("Unable to preload profiles: %s" % e)
+
+	def refresh(self):
+		signature = self.current_signature()
+		if signature != self.signature:
+			# the signature is taken before loading, so that changes made while loading are noticed next time:
+			self.load()
+			self.signature = signature
+
+	def listen(self):
+		os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+		if os.path.exists(self.socket_path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.socket_path)
+				Output.fatal("An ego daemon is already listening on %s." % self.socket_path)
+			except ConnectionRefusedError:
+				# left behind by a daemon that didn't exit cleanly:
+				os.unlink(self.socket_path)
+			finally:
+				probe.close()
+		self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.listener.bind(self.socket_path)
+		# Any user may connect. Their commands run with their own permissions:
+		os.chmod(self.socket_path, 0o666)
+		self.listener.listen(64)
+		with open(self.lock_path, "a"):
+			pass
+		os.chmod(self.lock_path, 0o644)
+
+	def stop(self, signum=None, frame=None):
+		self.running = False
+
+	def serve(self):
+		if not hasattr(socket, "recv_fds"):
+			Output.fatal("The ego daemon requires Python 3.9 or later.")
+		self.code_signature = self.file_signature(self.code_files())
+		self.refresh()
+		self.listen()
+		self.running = True
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		Output.log("ego daemon listening on %s." % self.socket_path)
+		poller = select.poll()
+		poller.register(self.listener, select.POLLIN)
+		try:
+			while self.running:
+				try:
+					events = poller.poll(1000)
+				except InterruptedError:
+					continue
+				for fd, event in events:
+					if fd == self.listener.fileno():
+						self.accept(poller)
+					else:
+						self.client_gone(poller, fd)
+				self.reap(poller)
+		finally:
+			self.listener.close()
+			try:
+				os.unlink(self.socket_path)
+			except OSError:
+				pass
+
+	def accept(self, poller):
+		try:
+			conn, address = self.listener.accept()
+		except OSError:
+			return
+		self.refresh()
+		pid = os.fork()
+		if pid == 0:
+			status = 1
+			try:
+				self.listener.close()
+				status = self.handle(conn)
+			finally:
+				os._exit(status)
+		self.children[pid] = conn
+		# Tells us when the client goes away, without reacting to the request it sends:
+		poller.register(conn, select.POLLRDHUP)
+		self.watched.add(conn.fileno())
+
+	def client_gone(self, poller, fd):
+		# The client was interrupted (such as with Ctrl-C) while its command was running. Interrupt the command too:
+		poller.unregister(fd)
+		self.watched.discard(fd)
+		for pid, conn in self.children.items():
+			if conn.fileno() == fd:
+				try:
+					os.kill(pid, signal.SIGINT)
+				except ProcessLookupError:
+					pass
+
+	def reap(self, poller):
+		while self.children:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			conn = self.children.pop(pid, None)
+			if conn is not None:
+				if conn.fileno() in self.watched:
+					self.watched.discard(conn.fileno())
+					poller.unregister(conn)
+				conn.close()
+
+	def handle(self, conn):
+		"""Runs in the child process. Reads the client's request, runs its command, and returns our exit status."""
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.default_int_handler)
+		try:
+			data, fds, flags, address = socket.recv_fds(conn, 65536, 3)
+			if len(fds) != 3:
+				return 1
+			request, rest = read_message(conn, data)
+			if request is None:
+				return 1
+			pid, uid, gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+		except (OSError, ValueError):
+			return 1
+		refused = self.check_request(request, uid)
+		if refused is not None:
+			conn.sendall(json.dumps({"refused": refused}).encode("utf-8") + b"\n")
+			return 0
+		Output.debug("Running %s for uid %s (pid %s)." % (" ".join(request["argv"]), uid, pid))
+		lock_fd = os.open(self.lock_path, os.O_RDONLY)
+		for target, fd in enumerate(fds):
+			if fd != target:
+				os.dup2(fd, target)
+				os.close(fd)
+		status = self.run_command(request, uid, gid, lock_fd)
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		try:
+			conn.sendall(json.dumps({"status": status}).encode("utf-8") + b"\n")
+		except OSError:
+			pass
+		return 0
+
+	def check_request(self, request, uid):
+		"""Returns why we can't run ``request`` from user ``uid``, or None if we can."""
+		if request.get("version") != PROTOCOL_VERSION:
+			return "unsupported protocol version"
+		if request["root_path"] != self.config.root_path or request["settings_path"] != self.config.settings_path:
+			return "different ROOT or configuration file"
+		if request.get("install_path") != self.config.ego_dir or request.get("ego_version") != self.version:
+			return "different ego installation or version"
+		if self.file_signature(self.code_files()) != self.code_signature:
+			return "ego was updated since the ego daemon started"
+		if uid != os.getuid() and os.getuid() != 0:
+			return "running as a different user"
+		return None
+
+	def run_command(self, request, uid, gid, lock_fd):
+		import pwd
+
+		sys.argv = request["argv"]
+		os.environ.clear()
+		os.environ.update(request["env"])
+		self.config.read_environment()
+		if uid != os.getuid():
+			os.initgroups(pwd.getpwuid(uid).pw_name, gid)
+			os.setgid(gid)
+			os.setuid(uid)
+		sys.stdin = open(0, "r", closefd=False)
+		sys.stdout = open(1, "w", buffering=1 if os.isatty(1) else -1, closefd=False)
+		sys.stderr = open(2, "w", buffering=1, closefd=False)
+		setup_terminal()
+		EgoModule.lock_fd = lock_fd
+		try:
+			os.chdir(request["cwd"])
+			dispatch(self.config, self.version)
+			status = 0
+		except SystemExit as e:
+			if e.code is None:
+				status = 0
+			elif isinstance(e.code, int):
+				status = e.code
+			else:
+				sys.stderr.write("%s\n" % e.code)
+				status = 1
+		except KeyboardInterrupt:
+			status = 130
+		except OSError as e:
+			sys.stderr.write("ego: %s\n" % e)
+			status = 1
+		for f in [sys.stdout, sys.stderr]:
+			try:
+				f.flush()
+			except OSError:
+				pass
+		return status
+
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def is_ego_module(name):
+	return name == "ego" or name.startswith("ego.") or name.startswith("ego_module_")
+
+
+class _TimedLoader(object):
+	"""Wraps the loader of a module being imported, so that the time spent loading it is recorded."""
+
+	def __init__(self, profiler, name, loader):
+		self.profiler = profiler
+		self.name = name
+		self.loader = loader
+
+	def __getattr__(self, attr):
+		return getattr(self.loader, attr)
+
+	def create_module(self, spec):
+		with self.profiler.section(self.name):
+			return self.loader.create_module(spec)
+
+	def exec_module(self, module):
+		with self.profiler.section(self.name):
+			return self.loader.exec_module(module)
+
+
+class ImportProfiler(object):
+	"""
+	Records how long each module takes to import, similar to ``python -X importtime``. Every import is also attributed
+	to the ego module (a module of the ``ego`` package, or an ``.ego`` module) that caused it, so that the cost of
+	third-party imports shows up against the ego code that pulled them in.
+
+	``install()`` adds the profiler to ``sys.meta_path``; only modules imported after that are recorded.
+	"""
+
+	def __init__(self):
+		self.records = OrderedDict()
+		self.stack = []
+		self.start = time.perf_counter()
+
+	def install(self):
+		sys.meta_path.insert(0, self)
+
+	def uninstall(self):
+		if self in sys.meta_path:
+			sys.meta_path.remove(self)
+
+	def find_spec(self, name, path=None, target=None):
+		for finder in sys.meta_path:
+			if finder is self or not hasattr(finder, "find_spec"):
+				continue
+			spec = finder.find_spec(name, path, target)
+			if spec is not None:
+				break
+		else:
+			return None
+		if spec.loader is not None:
+			spec.loader = _TimedLoader(self, name, spec.loader)
+		return spec
+
+	def importer(self):
+		for frame in reversed(self.stack):
+			if is_ego_module(frame["name"]):
+				return frame["name"]
+		return "ego"
+
+	@contextmanager
+	def section(self, name):
+		"""Records the time spent in the ``with`` block as (part of) the import of ``name``."""
+		if name not in self.records:
+			importer = self.importer()
+			self.records[name] = {
+				"name": name,
+				"imported_by": importer,
+				# time spent importing ego modules themselves is attributed to them, everything else to their importer:
+				"owner": name if is_ego_module(name) else importer,
+				"self": 0.0,
+				"cumulative": 0.0,
+			}
+		frame = {"name": name, "children": 0.0}
+		self.stack.append(frame)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			self.stack.pop()
+			record = self.records[name]
+			record["cumulative"] += elapsed
+			record["self"] += elapsed - frame["children"]
+			if self.stack:
+				self.stack[-1]["children"] += elapsed
+
+	def total(self):
+		return sum(record["self"] for record in self.records.values())
+
+	def by_owner(self):
+		"""Returns ``[(owner, number of imports, total self time)]``, most expensive first."""
+		owners = OrderedDict()
+		for record in self.records.values():
+			count, duration = owners.get(record["owner"], (0, 0.0))
+			owners[record["owner"]] = (count + 1, duration + record["self"])
+		return sorted(((owner, count, duration) for owner, (count, duration) in owners.items()), key=lambda x: -x[2])
+
+	def report(self, out=None, limit=25):
+		if out is None:
+			out = sys.stdout
+		slowest = sorted(self.records.values(), key=lambda r: -r["cumulative"])[:limit]
+		out.write("\n  %s %s %s  %s\n" % ("cumulative".rjust(10), "self".rjust(10), "module".ljust(40), "imported by"))
+		for record in slowest:
+			out.write(
+				"  %9.1fms %9.1fms %s  %s\n"
+				% (record["cumulative"] * 1000, record["self"] * 1000, record["name"].ljust(40), record["imported_by"])
+			)
+		out.write("\n  %s %s %s\n" % ("ego module".ljust(40), "imports".rjust(8), "time".rjust(10)))
+		for owner, count, duration in self.by_owner():
+			out.write("  %s %8d %9.1fms\n" % (owner.ljust(40), count, duration * 1000))
+		out.write(
+			"\n  %s modules imported in %.1fms (%.1fms since profiling started).\n\n"
+			% (len(self.records), self.total() * 1000, (time.perf_counter() - self.start) * 1000)
+		)
+
+
+# vim: ts=4 sw=4 noet
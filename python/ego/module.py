@@ -1,19 +1,28 @@
 import argparse
+import contextlib
 import importlib.machinery
+import importlib.util
+import marshal
+import struct
 import sys
 import os
+import zlib
 
 from ego.output import Color, Output
-from ego.config import EgoConfig
+from ego.config import EgoConfig, atomic_write, is_trusted, is_trusted_dir
 
-try:
-	has_mw_parser = True
-	from mediawiki.cli_parser import wikitext_parse
-except ImportError:
-	has_mw_parser = False
-	pass
+__all__ = ["EgoModule", "EgoModuleLoader", "dispatch", "render_wikitext", "usage"]
 
-__all__ = ["EgoModule", "usage"]
+
+def render_wikitext(wikitext, out, indent=""):
+	# The MediaWiki parser (and mwparserfromhell and tabulate, which it uses) is slow to import, so only import it
+	# when there is something to render:
+	try:
+		from mediawiki.cli_parser import wikitext_parse
+	except ImportError:
+		out.write(wikitext)
+		return
+	wikitext_parse(wikitext, out, indent=indent)
 
 
 def usage(config):
@@ -29,8 +38,82 @@ def usage(config):
 	print()
 
 
+class EgoModuleLoader(importlib.machinery.SourceFileLoader):
+	"""
+	Loader for ``.ego`` modules that caches their compiled bytecode. Python won't do this for files without a ``.py``
+	suffix, and could not write to ``__pycache__`` of a read-only install anyway, so the bytecode is stored in the first
+	writable directory of ``cache_dirs`` instead -- typically ``/var/cache/ego/modules``, then a per-user cache.
+
+	Each cache file starts with Python's bytecode magic number followed by the mtime (in nanoseconds) and size of the
+	source file, and is only used if all of these still match. Cache directories and files that can be written to by
+	anyone but the current user or root are never used.
+	"""
+
+	header = struct.Struct("<4sQQ")
+
+	def __init__(self, fullname, path, cache_dirs=None):
+		super().__init__(fullname, path)
+		self.cache_dirs = cache_dirs or []
+
+	def cache_name(self):
+		# include a hash of the source path, so that different installs (such as a git checkout) don't share entries:
+		path_hash = "%08x" % zlib.crc32(os.path.abspath(self.path).encode())
+		name = os.path.basename(self.path).rsplit(".", 1)[0]
+		return "%s-%s.%s.pyc" % (name, path_hash, sys.implementation.cache_tag)
+
+	def _read_cache(self, expected_header):
+		for cache_dir in self.cache_dirs:
+			# bytecode is run as-is, so only use files and directories that nobody but us or root can write to. This
+			# keeps root from running bytecode from the cache of the user whose $HOME it was started with, for instance:
+			if not is_trusted_dir(cache_dir):
+				continue
+			try:
+				with open(os.path.join(cache_dir, self.cache_name()), "rb") as f:
+					if not is_trusted(os.fstat(f.fileno())):
+						continue
+					data = f.read()
+			except OSError:
+				continue
+			if data[: self.header.size] == expected_header:
+				try:
+					return marshal.loads(data[self.header.size :])
+				except (EOFError, ValueError, TypeError):
+					continue
+		return None
+
+	def _write_cache(self, header, code):
+		if sys.dont_write_bytecode:
+			return
+		data = header + marshal.dumps(code)
+		for cache_dir in self.cache_dirs:
+			try:
+				os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+				if not is_trusted_dir(cache_dir):
+					continue
+				atomic_write(os.path.join(cache_dir, self.cache_name()), data)
+				return
+			except OSError:
+				continue
+
+	def get_code(self, fullname):
+		source_path = self.get_filename(fullname)
+		st = os.stat(source_path)
+		header = self.header.pack(importlib.util.MAGIC_NUMBER, st.st_mtime_ns, st.st_size)
+		code = self._read_cache(header)
+		if code is None:
+			code = self.source_to_code(self.get_data(source_path), source_path)
+			self._write_cache(header, code)
+		return code
+
+
 class EgoModule:
 
+	# set by the ego daemon, to a file that is locked while running commands that aren't read-only:
+	lock_fd = None
+
+	# modules that output records with Output.record() when run with --json set this:
+	supports_json = False
+
 	# I think it is time to add a "news" or "issues" functionality to Ego Modules, which would allow an ego
 	# module to register information that would be presented to the user, even at a later invocation of ego.
 	# I plan to use this to implement the ability to have "post-kit-change" actions, which can be performed
@@ -51,21 +134,25 @@ class EgoModule:
 		self.info = config.ego_mods_info[name]
 		self.version = VERSION
 		self.options = None
+		self.json = False
 		self.msgs = []
 		self.setup()
 
 	def _no_repo_available(self, exit=True):
 		wikitext = "{{Note|Meta-repo has not yet been cloned, so no kit information is available. Type {{c|ego sync}}"
 		wikitext += " to perform an initial clone of meta-repo.}}"
-		if has_mw_parser:
-			wikitext_parse(wikitext, sys.stdout, indent="  ")
-		else:
-			sys.stdout.write(wikitext)
+		render_wikitext(wikitext, sys.stdout, indent="  ")
 		sys.stdout.write("\n")
 		if exit:
 			sys.exit(1)
 
 	def __call__(self, *args):
+		# --json may also be given after an action, such as 'ego kit list --json':
+		args = list(args)
+		end = args.index("--") if "--" in args else len(args)
+		json_output = "--json" in args[:end]
+		if json_output:
+			args.remove("--json")
 		parser = argparse.ArgumentParser("ego " + self.name, description=self.info["description"])
 		if self.version:
 			parser.add_argument(
@@ -85,14 +172,32 @@ class EgoModule:
 		verbosity_group.add_argument("--verbosity", default=1, type=int, help="Set verbosity level")
 		verbosity_group.add_argument("-v", default=0, action="count", help="Increase verbosity level by 1 per occurrence")
 		verbosity_group.add_argument("-q", default=0, action="count", help="Decrease verbosity level by 1 per occurrence")
+		parser.add_argument("--json", action="store_true", help="Output JSON records to stdout, and all messages to stderr")
 		self.add_arguments(parser)
 		options = parser.parse_args(args)
 		self.options = options
 		options = vars(options)
 		options["parser"] = self.parser = parser
 		Output.verbosity = options.pop("verbosity") + options.pop("v") - options.pop("q")
+		self.json = options.pop("json") or json_output
+		if self.json and not self.supports_json:
+			parser.error("--json is not supported by ego %s" % self.name)
+
+		if self.lock_fd is not None and not self.read_only():
+			import fcntl
 
-		self.handle()
+			fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+		if self.json:
+			# anything that isn't a record goes to stderr, so that stdout can be parsed:
+			Output.json_stdout = sys.stdout
+			try:
+				with contextlib.redirect_stdout(sys.stderr):
+					self.handle()
+			finally:
+				Output.json_stdout = None
+		else:
+			self.handle()
 
 	def add_arguments(self, parser):
 		pass
@@ -100,11 +205,51 @@ class EgoModule:
 	def handle(self):
 		raise NotImplementedError
 
+	def read_only(self):
+		"""
+		Returns True if running this module with the parsed ``self.options`` can't change anything on the system. The ego
+		daemon only runs one command at a time that isn't read-only.
+		"""
+		return False
+
+	@staticmethod
+	def module_cache_dirs(config):
+		cache_dirs = []
+		cache_dir = getattr(config, "cache_dir", None)
+		if cache_dir is not None:
+			cache_dirs.append(os.path.join(cache_dir, "modules"))
+		user_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+		cache_dirs.append(os.path.join(user_cache, "ego", "modules"))
+		return cache_dirs
+
+	@classmethod
+	def load_ego_module(cls, modname, config):
+		"""Loads ``modules/<modname>.ego`` and returns the Python module. Raises FileNotFoundError if it doesn't exist."""
+		path = "%s/modules/%s.ego" % (config.ego_dir, modname)
+		# use a distinct name, so that modules such as 'profile' don't shadow standard library modules:
+		name = "ego_module_%s" % modname
+		st = os.stat(path)
+		signature = (st.st_mtime_ns, st.st_size)
+		mod = sys.modules.get(name)
+		if mod is not None and getattr(mod, "__ego_signature__", None) == signature:
+			# already loaded by the ego daemon:
+			return mod
+		loader = EgoModuleLoader(name, path, cache_dirs=cls.module_cache_dirs(config))
+		spec = importlib.util.spec_from_file_location(name, path, loader=loader)
+		mod = importlib.util.module_from_spec(spec)
+		sys.modules[name] = mod
+		try:
+			spec.loader.exec_module(mod)
+		except BaseException:
+			del sys.modules[name]
+			raise
+		mod.__ego_signature__ = signature
+		return mod
+
 	@classmethod
 	def run_ego_module(cls, modname, config, args, VERSION=None):
-		loader = importlib.machinery.SourceFileLoader(modname, "%s/modules/%s.ego" % (config.ego_dir, modname))
 		try:
-			mod = loader.load_module()
+			mod = cls.load_ego_module(modname, config)
 			if mod:
 				ego_module = mod.Module(modname, config, VERSION)
 				ego_module(*args)
@@ -115,4 +260,70 @@ class EgoModule:
 			return None
 
 
+def dispatch(econfig, VERSION=None):
+	"""Runs the ego command in ``sys.argv``."""
+	exec_name = os.path.basename(sys.argv[0])
+	action = None
+	args = []
+	if exec_name != "ego":
+		# called as shortcut symlink
+		action = econfig.modules.module_for_shortcut(exec_name)
+		args = sys.argv[1:]
+		if not action:
+			print(Color.RED + "Unrecognized shortcut %s. Type ego help for more info." % exec_name + Color.END)
+			sys.exit(1)
+	else:
+		# generic help display
+		if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] in ["info", "help"]):
+			usage(econfig)
+		elif len(sys.argv) == 3 and sys.argv[1] in ["info", "help"]:
+			# ego help query, etc.
+			mod = sys.argv[2]
+			action = sys.argv[1]
+			if not econfig.modules.exists(mod):
+				print("Module not found: %s. Exiting." % mod)
+				sys.exit(1)
+			if mod not in econfig.ego_mods_info:
+				print("No %s is available for %s ego module." % (action, mod))
+			else:
+				if action == "info":
+					print("Extended information for %s ego module:" % mod)
+					for key in econfig.ego_mods_info[mod]:
+						print("%20s: %s" % (key, econfig.ego_mods_info[mod][key]))
+					print()
+				else:
+					if "help" in econfig.ego_mods_info[mod]:
+						print(econfig.ego_mods_info[mod]["help"])
+					else:
+						print("No help available for this ego module.")
+			action = None
+		elif len(sys.argv) >= 2:
+			# called as 'ego'
+			action = sys.argv[1]
+			args = sys.argv[2:]
+		else:
+			print(Color.RED + "Please specify an action. Type ego help for more info." + Color.END)
+			sys.exit(1)
+	if action:
+		try:
+			EgoModule.run_ego_module(action, econfig, args, VERSION)
+		except PermissionError:
+			Output.fatal("Permissions error -- please make sure you are running this command as the correct user.")
+		except KeyboardInterrupt:
+			Output.fatal("Interrupted -- exiting.")
+		except Exception as e:
+			Output.error("Ego encountered an unexpected error: " + e.__class__.__name__)
+			try:
+				outfile = "/tmp/ego-traceback-%s.txt" % os.getpid()
+				with open(outfile, "w") as f:
+					import traceback
+
+					f.write(str(e))
+					f.write(traceback.format_exc())
+				Output.error("Full traceback written to %s." % outfile)
+			except (PermissionError, IOError):
+				Output.error("Unable to write full traceback.")
+			sys.exit(1)
+
+
 # vim: ts=4 sw=4 noexpandtab
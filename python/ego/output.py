@@ -5,17 +5,11 @@
 # Copyright 2017-2018 Funtoo Solutions, Inc., Daniel Robbins and contributors.
 # See LICENSE.txt for terms of distribution.
 
+import json
 import sys
 import textwrap
 import shutil
 
-if sys.stdout.isatty():
-	is_tty = True
-else:
-	is_tty = False
-
-term_size = shutil.get_terminal_size((80, 20))
-
 
 def ago(diff):
 
@@ -62,17 +56,20 @@ class ColorType(str):
 
 
 class Color(object):
-	PURPLE = ColorType("\033[35m" if is_tty else "")
-	CYAN = ColorType("\033[36m" if is_tty else "")
-	DARKCYAN = ColorType("\033[36m" if is_tty else "")
-	DARKBLUEBG = ColorType("\033[44m" if is_tty else "")
-	BLUE = ColorType("\033[34m" if is_tty else "")
-	GREEN = ColorType("\033[32m" if is_tty else "")
-	YELLOW = ColorType("\033[33m" if is_tty else "")
-	RED = ColorType("\033[31m" if is_tty else "")
-	BOLD = ColorType("\033[1m" if is_tty else "")
-	UNDERLINE = ColorType("\033[4m" if is_tty else "")
-	END = ColorType("\033[0m" if is_tty else "")
+	# Color.PURPLE, etc. are set from these by setup_terminal(), and are empty when not writing to a terminal:
+	codes = {
+		"PURPLE": "\033[35m",
+		"CYAN": "\033[36m",
+		"DARKCYAN": "\033[36m",
+		"DARKBLUEBG": "\033[44m",
+		"BLUE": "\033[34m",
+		"GREEN": "\033[32m",
+		"YELLOW": "\033[33m",
+		"RED": "\033[31m",
+		"BOLD": "\033[1m",
+		"UNDERLINE": "\033[4m",
+		"END": "\033[0m",
+	}
 	AUTOFLUSH = ColorType("")
 
 	@classmethod
@@ -137,6 +134,21 @@ class Color(object):
 		return self + self.default(" " * (width - len(self)))
 
 
+def setup_terminal():
+	"""
+	Checks whether stdout is a terminal, and its width, and sets up colors accordingly. This is done when ego starts,
+	and again by the ego daemon when it starts writing to a client's stdout.
+	"""
+	global is_tty, term_size
+	is_tty = sys.stdout.isatty()
+	term_size = shutil.get_terminal_size((80, 20))
+	for name, code in Color.codes.items():
+		setattr(Color, name, ColorType(code if is_tty else ""))
+
+
+setup_terminal()
+
+
 def mesg(msgtype, msg, entry=None):
 	global term_size, Output
 	""" prints different types of messages to the console """
@@ -175,6 +187,8 @@ def mesg(msgtype, msg, entry=None):
 class Output:
 
 	verbosity = 1
+	# while a module runs with --json, the real stdout, where records go (all other output goes to stderr):
+	json_stdout = None
 
 	@classmethod
 	def header(cls, info):
@@ -220,6 +234,13 @@ class Output:
 		if cls.verbosity > -1:
 			cls._output(Color.red("ERROR: " + str(message)), err=True)
 
+	@classmethod
+	def record(cls, data):
+		"""Output ``data`` as JSON to stdout, for ``--json``."""
+		out = cls.json_stdout or sys.stdout
+		out.write(json.dumps(data, indent=4) + "\n")
+		out.flush()
+
 	@classmethod
 	def fatal(cls, message, exit_code=1):
 		"""Output error message to stderr and exit. Auto-append newline if missing."""
@@ -10,16 +10,112 @@ very clean, easy-to-understand, well-documented with concepts clearly explained,
 """
 
 import json
+import marshal
 import os
+import sys
+from array import array
+from bisect import bisect_left
 from enum import Enum
 import errno
 from collections import OrderedDict, defaultdict
 from ego.output import Output
-from ego.config import join_path, EgoConfig
+from ego.config import atomic_write, is_trusted, is_trusted_dir, join_path, EgoConfig, MetadataCache
+from git_reader import GitReader
 from configparser import ConfigParser
 import configparser
 
 
+class ParentFileCache(object):
+	"""
+	Process-wide cache of the lines of profile ``parent`` files. Entries are keyed by path and validated against the
+	file's mtime, size and inode on each access, so that building another ``ProfileTree`` over an unchanged profile
+	hierarchy only needs a ``stat`` of each ``parent`` file. The entries are also kept in a file in ego's cache
+	directory, if it is writable, so that they can be used by the next ego command too.
+	"""
+
+	format_version = 1
+
+	def __init__(self):
+		self.entries = {}
+		self.path = None
+		self.dirty = False
+		self.hits = 0
+		self.misses = 0
+
+	def use_file(self, path):
+		"""Adds the entries stored in ``path`` (if they are still valid when used), and stores them there on ``save()``."""
+		if path == self.path:
+			return
+		self.path = path
+		# entries are used in place of parent files whose mtime, size and inode match, so only use a file that nobody but
+		# us or root can write to:
+		if not is_trusted_dir(os.path.dirname(path)):
+			return
+		try:
+			with open(path, "rb") as f:
+				if not is_trusted(os.fstat(f.fileno())):
+					return
+				data = marshal.load(f)
+		except (OSError, EOFError, ValueError, TypeError):
+			return
+		if not isinstance(data, dict) or data.get("format") != self.format_version:
+			return
+		# the marshal format is specific to the Python version:
+		if data.get("python") != tuple(sys.version_info[:2]):
+			return
+		for fn, (sig, lines) in data["entries"].items():
+			self.entries.setdefault(fn, (tuple(sig), tuple(lines)))
+
+	def lines(self, parent_dir):
+		"""Returns the profile lines of the ``parent`` file in ``parent_dir``, or no lines if there is none."""
+		fn = os.path.join(parent_dir, "parent")
+		try:
+			st = os.stat(fn)
+		except OSError:
+			return ()
+		sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+		entry = self.entries.get(fn)
+		if entry is not None and entry[0] == sig:
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		lines = []
+		with open(fn, "r") as f:
+			for line in f.readlines():
+				if len(line) and line[0] == "#":
+					continue
+				elif len(line) == 0:
+					continue
+				lines.append(line.strip())
+		self.entries[fn] = (sig, tuple(lines))
+		self.dirty = True
+		return self.entries[fn][1]
+
+	def save(self):
+		if not self.dirty or self.path is None:
+			return
+		self.dirty = False
+		data = {"format": self.format_version, "python": tuple(sys.version_info[:2]), "entries": self.entries}
+		try:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			atomic_write(self.path, marshal.dumps(data))
+		except OSError as e:
+			Output.debug("Unable to write %s: %s" % (self.path, e))
+
+	def clear(self):
+		self.entries = {}
+		self.dirty = False
+
+	def __str__(self):
+		return "%s hits, %s misses" % (self.hits, self.misses)
+
+
+parent_cache = ParentFileCache()
+
+# parsed profile-catalog.json, kept apart from metadata_cache so that it doesn't count towards its hits and misses:
+catalog_index_cache = MetadataCache()
+
+
 def all_funtoo_repos(config):
 	dict_out = {}
 	conf_in = ConfigParser()
@@ -146,11 +242,12 @@ class MetaProfileCatalog:
 		self.config = config
 		self.catalogs = OrderedDict()
 		self.funtoo_repos = funtoo_repos
+		index = ProfileCatalogIndex(config)
 		for repo, repo_info in funtoo_repos.items():
 			if not repo_info["has_profiles"]:
 				continue
 			pa = repo_info["config"]["location"]
-			self.catalogs[repo] = ProfileCatalog(repo, config, pa + "/profiles")
+			self.catalogs[repo] = ProfileCatalog(repo, config, pa + "/profiles", index=index.entry(repo, pa))
 
 	def set_arch(self, arch=None):
 		for repo_name, catalog in self.catalogs.items():
@@ -203,17 +300,22 @@ class ProfileCatalog:
 
 	"""
 
-	def __init__(self, repo_name, config, profile_root):
+	def __init__(self, repo_name, config, profile_root, index=None):
 		self.config = config
 		self.repo_name = repo_name
 		self.profile_root = profile_root
 		self.egodescfile = self.profile_root + "/profiles.ego.desc"
 		self.directory_map = defaultdict(dict)
 		self.json_info = {}
-		if os.path.exists(self.egodescfile):
-			with open(self.egodescfile, "r") as ed:
+		egodescfile = join_path(config.root_path, self.egodescfile)
+		if os.path.exists(egodescfile):
+			with open(egodescfile, "r") as ed:
 				self.json_info = json.loads(ed.read())
 		self.arch = None
+		# the entry of this repo in the ProfileCatalogIndex, if it is up-to-date:
+		self.index = index
+		# directory -> names of the profiles in it, for directories that have been scanned:
+		self.scanned = {}
 
 	# keys() returns a list of types of sub-profiles that are defined on this system.
 
@@ -237,6 +339,56 @@ class ProfileCatalog:
 		except KeyError:
 			return None
 
+	def directories(self, key, arch=None):
+		"""
+		Returns the directories, relative to the profile root, containing profiles of ProfileType ``key``. With ``arch``,
+		only the directories of ``subarch`` and arch-specific mix-in profiles of that arch are returned.
+		"""
+		if arch is None:
+			return [self.json_info[str(key)]] if str(key) in self.json_info else []
+		if key == ProfileType.SUBARCH and str(ProfileType.ARCH) in self.json_info:
+			return [self.json_info[str(ProfileType.ARCH)] + "/" + arch + "/subarch"]
+		elif key == ProfileType.MIX_IN and str(ProfileType.MIX_IN) in self.json_info:
+			return [self.json_info[str(ProfileType.MIX_IN)] + "/" + arch + "/mix-ins"]
+		return []
+
+	def scan(self, dirname):
+		"""Returns the names of the profiles (subdirectories) in ``dirname``, looking at the directory only once."""
+		names = self.scanned.get(dirname)
+		if names is None:
+			names = []
+			p = join_path(self.config.root_path, self.profile_root + "/" + dirname)
+			try:
+				with os.scandir(p) as entries:
+					for entry in entries:
+						if entry.is_dir():
+							names.append(entry.name)
+			except OSError as e:
+				if e.errno not in (errno.ENOTDIR, errno.ENOENT, errno.ESTALE):
+					raise
+			self.scanned[dirname] = names
+		return names
+
+	def profiles(self, key, arch=None):
+		"""
+		Returns a list of (name, relative path) of the profiles of ProfileType ``key``. With ``arch``, only the
+		``subarch`` and arch-specific mix-in profiles of that arch are returned. These come from the index when it is
+		up-to-date, and from the profile directories otherwise.
+		"""
+		if self.index is not None:
+			return list(self.index["profiles"].get(arch or "", {}).get(str(key), {}).items())
+		return [(name, dirname + "/" + name) for dirname in self.directories(key, arch) for name in self.scan(dirname)]
+
+	def index_entry(self):
+		"""Returns the profiles of this repository, by arch ("" if not arch-specific) and ProfileType, for the index."""
+		by_arch = OrderedDict()
+		by_arch[""] = OrderedDict((str(key), OrderedDict(self.profiles(key))) for key in ProfileType.valid())
+		for arch, path in self.profiles(ProfileType.ARCH):
+			by_arch[arch] = OrderedDict(
+				(str(key), OrderedDict(self.profiles(key, arch))) for key in [ProfileType.SUBARCH, ProfileType.MIX_IN]
+			)
+		return by_arch
+
 	def list(self, key, arch=None):
 
 		"""
@@ -251,38 +403,66 @@ class ProfileCatalog:
 		if not arch and self.arch:
 			arch = self.arch
 
-		dirlist = []
-
-		if arch is not None:
-
-			if key == ProfileType.SUBARCH:
-				dirlist = [self.json_info[str(ProfileType.ARCH)] + "/" + arch + "/subarch"]
-			elif key == ProfileType.MIX_IN:
-				dirlist = [self.json_info[str(ProfileType.MIX_IN)] + "/" + arch + "/mix-ins"]
-
-		if str(key) in self.json_info:
-			dirlist += [self.json_info[str(key)]]
-
 		# For now, disable defining new arches in overlays. This prevents extra arches from being displayed when
 		# sub-arches are defined.
 
 		if self.repo_name != "core-kit" and key == ProfileType.ARCH:
 			return
 
-		for dirname in dirlist:
-			p = join_path(self.config.root_path, self.profile_root + "/" + dirname)
-			try:
-				for profile_root in os.listdir(p):
-					if os.path.isdir(p + "/" + profile_root):
-						self.directory_map[key][profile_root] = dirname + "/" + profile_root
-						if self.repo_name != "core-kit":
-							yield self.repo_name + ":" + profile_root
-						else:
-							yield profile_root
-			except OSError as e:
-				if e.errno not in (errno.ENOTDIR, errno.ENOENT, errno.ESTALE):
-					raise
+		profiles = self.profiles(key, arch) if arch is not None else []
+		profiles += self.profiles(key)
+		for profile_root, path in profiles:
+			self.directory_map[key][profile_root] = path
+			if self.repo_name != "core-kit":
+				yield self.repo_name + ":" + profile_root
+			else:
+				yield profile_root
+
+
+class ProfileCatalogIndex(object):
+	"""
+	``ProfileCatalogIndex`` is an index of the profiles available in each repository with profiles, written by
+	``ego sync`` to ``profile-catalog.json`` in ego's cache directory. For each repository, it records the commit
+	that the repository was at, and the name and path of each profile by arch and type, so that ``ProfileCatalog``
+	can list profiles without looking at the profile directories. The entry of a repository is only used while the
+	repository is still at that commit.
+	"""
+
+	format_version = 1
+
+	def __init__(self, config):
+		self.config = config
+		self.path = os.path.join(config.cache_dir, "profile-catalog.json")
+
+	def repo_commit(self, location):
+		return GitReader(join_path(self.config.root_path, location)).head()
+
+	def write(self, funtoo_repos):
+		index = {"format": self.format_version, "repos": OrderedDict()}
+		for repo, repo_info in funtoo_repos.items():
+			if not repo_info["has_profiles"]:
+				continue
+			commit = self.repo_commit(repo_info["config"]["location"])
+			if commit is None:
+				# not a git repository, so there is no way to tell whether the index is up-to-date:
 				continue
+			catalog = ProfileCatalog(repo, self.config, repo_info["config"]["location"] + "/profiles")
+			index["repos"][repo] = {"commit": commit, "profiles": catalog.index_entry()}
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		atomic_write(self.path, json.dumps(index))
+
+	def entry(self, repo_name, location):
+		"""Returns the index entry of a repository, or None if there is none or it is not up-to-date."""
+		try:
+			index = catalog_index_cache.load(self.path)
+		except (OSError, ValueError):
+			return None
+		if not isinstance(index, dict) or index.get("format") != self.format_version:
+			return None
+		entry = index["repos"].get(repo_name)
+		if entry is None or entry["commit"] != self.repo_commit(location):
+			return None
+		return entry
 
 
 class ProfileSpecifier(object):
@@ -342,23 +522,23 @@ class ProfileSpecifier(object):
 			if self.spec_str[0] == ":":
 				# ":base" format -- relative to root of profile directory:
 				# TODO: this may not be correct -- should ":foo" be relative to the base of whatever profile we happen to be in?
-				self._resolved_path = os.path.join(self.tree.master_catalog.profile_root, self.spec_str[1:])
+				key = (self.tree.master_catalog.profile_root, self.spec_str[1:])
 			else:
 				colsplit = self.spec_str.split(":")
 				if len(colsplit) == 2 and colsplit[0] in self.tree.funtoo_repos.keys():
 					# "gentoo:foo" format - relative to a specified repo:
-					rel_path = self.tree.funtoo_repos[colsplit[0]]["config"]["location"]
-					self._resolved_path = os.path.join(rel_path, "profiles", colsplit[1])
+					rel_path = join_path(self.tree.config.root_path, self.tree.funtoo_repos[colsplit[0]]["config"]["location"])
+					key = (os.path.join(rel_path, "profiles"), colsplit[1])
 					# TODO: handle situation where for some reason, we have a repo entry referencing a non-existing repo
 				else:
 					if self.spec_str.startswith("/"):
 						# absolute path
-						self._resolved_path = self.spec_str
+						key = ("/", self.spec_str)
 					else:
 						# relative path format - relative to current location.
-						self._resolved_path = os.path.join(self.cwd, self.spec_str)
+						key = (self.cwd, self.spec_str)
 
-			self._resolved_path = os.path.normpath(self._resolved_path)
+			self._resolved_path = os.path.normpath(os.path.join(*key))
 
 		return self._resolved_path
 
@@ -382,15 +562,64 @@ class ProfileSpecifier(object):
 		"""
 		if self._profile_type is not None:
 			return self._profile_type
+		self._profile_type = ProfileType.OTHER
 		try:
 			kind = self.resolved_path.split("/")[-2:-1][0]
 			for ptype in list(ProfileType):
 				if kind == str(ptype):
 					self._profile_type = ptype
-					return ptype
+					break
 		except IndexError:
 			pass
-		return ProfileType.OTHER
+		return self._profile_type
+
+
+class ProfileTreeIndex(object):
+	"""
+	``ProfileTreeIndex`` is a flattened view of a profile hierarchy, used by ``ProfileTree`` to find inherited profiles
+	without walking the hierarchy each time. The profiles are stored in ``specs`` in depth-first order -- the order of
+	``ProfileTree.recursively_get_children()`` -- so that everything inherited by the profile at position ``pos`` is at
+	the positions from ``pos + 1`` up to ``ends[pos]``. ``buckets`` holds the sorted positions of the profiles of each
+	``ProfileType``, so the profiles of a type inherited by a profile can be found with a binary search.
+	"""
+
+	def __init__(self, profile_hier):
+		self.specs = []
+		self.ends = array("i")
+		self.buckets = defaultdict(lambda: array("i"))
+		# resolved path -> position of the first profile with that path:
+		self.positions = {}
+		self._add(profile_hier)
+
+	def _add(self, child_dict):
+		for spec_obj, child_target_dict in child_dict.items():
+			pos = len(self.specs)
+			self.specs.append(spec_obj)
+			self.ends.append(pos + 1)
+			self.buckets[spec_obj.classify()].append(pos)
+			self.positions.setdefault(spec_obj.resolved_path, pos)
+			self._add(child_target_dict)
+			self.ends[pos] = len(self.specs)
+
+	def get(self, child_types=None, start=0, end=None):
+		"""
+		Returns the profiles of ``child_types`` (a ``ProfileType``, a list of them, or ``None`` for all types) at the
+		positions from ``start`` up to ``end``, in depth-first order.
+		"""
+		if end is None:
+			end = len(self.specs)
+		if child_types is None:
+			return self.specs[start:end]
+		if isinstance(child_types, ProfileType):
+			child_types = [child_types]
+		found = []
+		for child_type in set(child_types):
+			bucket = self.buckets.get(child_type)
+			if bucket:
+				found.extend(bucket[bisect_left(bucket, start):bisect_left(bucket, end)])
+		if len(child_types) > 1:
+			found.sort()
+		return [self.specs[pos] for pos in found]
 
 
 class ProfileTree(object):
@@ -422,6 +651,7 @@ class ProfileTree(object):
 		self.root_parent_dir = join_path(self.config.root_path, "/etc/portage/make.profile")
 		self.parent_map = defaultdict(None)
 		# put variable definitions above this line ^^
+		parent_cache.use_file(os.path.join(self.config.cache_dir, "profile-parents.marshal"))
 		self.reload()
 
 	def get_arch(self):
@@ -437,6 +667,42 @@ class ProfileTree(object):
 		# for each line in the parent file of the directory it references.
 
 		self.profile_hier = self._recurse(parent_lines=parent_lines)
+		self._index = None
+		parent_cache.save()
+
+	def _set_lines(self, new_lines):
+		"""
+		Changes the lines of the master parent file in-memory. Unlike ``reload()``, this keeps the ``ProfileSpecifier``
+		of each line that is still there, and only resolves the profiles of new lines. Profiles that have been resolved
+		before, including those inherited by any other line, are reused from ``profile_path_map``, so that no ``parent``
+		file is read again.
+
+		:param new_lines: The literal profile lines (strings) that the master parent file should now contain.
+		:return: None
+		"""
+		old_specs = defaultdict(list)
+		for spec_obj in self.profile_hier.keys():
+			old_specs[spec_obj.spec_str].append(spec_obj)
+		new_children = OrderedDict()
+		for spec_str in new_lines:
+			if old_specs[spec_str]:
+				spec_obj = old_specs[spec_str].pop(0)
+				new_children[spec_obj] = self.profile_hier[spec_obj]
+			else:
+				spec_obj = ProfileSpecifier(self, self.root_parent_dir, spec_str, None)
+				self.parent_map[spec_obj] = None
+				new_children[spec_obj] = self._recurse(spec_obj, _parent=spec_obj, repo_name=spec_obj.repo_name)
+		self.profile_path_map[self.root_parent_dir] = new_children
+		self.profile_hier = new_children
+		self._index = None
+		parent_cache.save()
+
+	@property
+	def index(self):
+		"""A ``ProfileTreeIndex`` of the profile hierarchy, built the first time it is needed after a change."""
+		if self._index is None:
+			self._index = ProfileTreeIndex(self.profile_hier)
+		return self._index
 
 	@property
 	def master_parent_file(self):
@@ -478,7 +744,7 @@ class ProfileTree(object):
 		for spec_obj in self.profile_hier.keys():
 			if spec_obj.spec_str != spec_str:
 				new_lines.append(spec_obj.spec_str)
-		self.reload(new_lines)
+		self._set_lines(new_lines)
 
 	def remove_name(self, profile_type, name):
 		"""
@@ -492,7 +758,7 @@ class ProfileTree(object):
 			for spec_obj in self.profile_hier.keys()
 			if not ((profile_type == spec_obj.classify()) and (spec_obj.name == name))
 		]
-		self.reload(new_lines)
+		self._set_lines(new_lines)
 
 	def append_mixin(self, spec_str):
 		"""
@@ -509,7 +775,7 @@ class ProfileTree(object):
 		if spec_str not in new_lines:
 			new_lines.append(spec_str)
 
-		self.reload(new_lines)
+		self._set_lines(new_lines)
 
 	def insert_or_replace_entry(self, profile_type, spec_str):
 
@@ -537,56 +803,108 @@ class ProfileTree(object):
 				new_lines.append(spec_str)
 			else:
 				new_lines.append(key_spec.spec_str)
-			line_types.append(key_spec)
+			line_types.append(key_spec.classify())
 
 		if not added:
-			if profile_type == ProfileType.ARCH:
-				insert_pos = 0
-			elif profile_type == ProfileType.FLAVOR:
-				try:
-					insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.BUILD) + 1
-				except StopIteration:
-					try:
-						# before first mix-in
-						insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.MIX_IN)
-					except StopIteration:
-						try:
-							# insert after subarch:
-							insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.SUBARCH) + 1
-						except StopIteration:
-							try:
-								# insert after arch:
-								insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.ARCH) + 1
-							except StopIteration:
-								insert_pos = 0
-			elif profile_type == ProfileType.BUILD:
+			new_lines.insert(self._insert_position(profile_type, line_types), spec_str)
+		self._set_lines(new_lines)
+
+	@staticmethod
+	def _insert_position(profile_type, line_types):
+		"""
+		Returns the position at which a line of a single-use ``profile_type`` belongs, in a master parent file with lines
+		of ``line_types`` (a list of ``ProfileType``) that has no line of that type yet.
+		"""
+
+		def first(of_type, offset=0):
+			return next(i for i, v in enumerate(line_types) if v == of_type) + offset
+
+		if profile_type == ProfileType.ARCH:
+			insert_pos = 0
+		elif profile_type == ProfileType.FLAVOR:
+			try:
+				insert_pos = first(ProfileType.BUILD, 1)
+			except StopIteration:
 				try:
-					# insert before flavor:
-					insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.FLAVOR)
+					# before first mix-in
+					insert_pos = first(ProfileType.MIX_IN)
 				except StopIteration:
 					try:
 						# insert after subarch:
-						insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.SUBARCH) + 1
+						insert_pos = first(ProfileType.SUBARCH, 1)
 					except StopIteration:
 						try:
 							# insert after arch:
-							insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.ARCH) + 1
+							insert_pos = first(ProfileType.ARCH, 1)
 						except StopIteration:
 							insert_pos = 0
-			elif profile_type == ProfileType.SUBARCH:
+		elif profile_type == ProfileType.BUILD:
+			try:
+				# insert before flavor:
+				insert_pos = first(ProfileType.FLAVOR)
+			except StopIteration:
 				try:
-					# insert after arch:
-					insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.ARCH) + 1
+					# insert after subarch:
+					insert_pos = first(ProfileType.SUBARCH, 1)
 				except StopIteration:
 					try:
-						# insert before build:
-						insert_pos = next(i for i, v in enumerate(line_types) if v.classify() == ProfileType.BUILD)
+						# insert after arch:
+						insert_pos = first(ProfileType.ARCH, 1)
 					except StopIteration:
 						insert_pos = 0
+		elif profile_type == ProfileType.SUBARCH:
+			try:
+				# insert after arch:
+				insert_pos = first(ProfileType.ARCH, 1)
+			except StopIteration:
+				try:
+					# insert before build:
+					insert_pos = first(ProfileType.BUILD)
+				except StopIteration:
+					insert_pos = 0
+		else:
+			raise KeyError("I do not not support profile type %s" % repr(profile_type))
+		return insert_pos
+
+	def apply(self, profiles):
+		"""
+		The ``apply()`` method changes the master parent file in-memory so that it enables exactly the profiles in
+		``profiles``, in a single step. Lines that already match are left alone, so applying the profiles that are
+		already enabled changes nothing.
+
+		:param profiles: A dict mapping a single-use ``ProfileType`` to the profile line (string) to use for it, and
+		  optionally ``ProfileType.MIX_IN`` to the list of lines of all mix-ins that should be enabled. Profile types
+		  that are not in ``profiles`` are not changed.
+		:return: True if the master parent file changed, False if not.
+		"""
+
+		old_lines = [spec_obj.spec_str for spec_obj in self.profile_hier.keys()]
+		lines = [(spec_obj.spec_str, spec_obj.classify()) for spec_obj in self.profile_hier.keys()]
+
+		for profile_type in ProfileType.single():
+			if profile_type not in profiles:
+				continue
+			spec_str = profiles[profile_type]
+			positions = [i for i, (line, line_type) in enumerate(lines) if line_type == profile_type]
+			if positions:
+				# replace the first line of this type, and drop any extra ones:
+				lines[positions[0]] = (spec_str, profile_type)
+				for i in reversed(positions[1:]):
+					del lines[i]
 			else:
-				raise KeyError(message="I do not not support profile type %s" % repr(profile_type))
-			new_lines.insert(insert_pos, spec_str)
-		self.reload(new_lines)
+				lines.insert(self._insert_position(profile_type, [line_type for line, line_type in lines]), (spec_str, profile_type))
+
+		if ProfileType.MIX_IN in profiles:
+			mix_ins = profiles[ProfileType.MIX_IN]
+			lines = [(line, line_type) for line, line_type in lines if line_type != ProfileType.MIX_IN or line in mix_ins]
+			enabled = set(line for line, line_type in lines)
+			lines += [(line, ProfileType.MIX_IN) for line in mix_ins if line not in enabled]
+
+		new_lines = [line for line, line_type in lines]
+		if new_lines == old_lines:
+			return False
+		self._set_lines(new_lines)
+		return True
 
 	def get_parent(self, spec_obj):
 		"""
@@ -601,9 +919,7 @@ class ProfileTree(object):
 		"""
 		Called by the ``reload()`` method (which is called by the constructor too), this method recurses over the master
 		parent file and loads a hierarchy of profile settings. Alternatively, one can specify profile lines using the
-		``parent_lines`` variable, in which case, these values are used instead (the ``parent_lines`` approach is used
-		by other methods to  *change* the master profile by specifying slightly different lines than are actually in the
-		parent file.)
+		``parent_lines`` variable, in which case, these values are used instead of the master parent file.
 
 
 		:param profile_path: A specified profile path to use, or ``/etc/portage/make.profile`` if None.
@@ -651,7 +967,7 @@ class ProfileTree(object):
 				# Otherwise, a list and we match all specified types:
 				yield child_path
 
-	def recursively_get_children(self, child_types=None, specifier=None, _child_dict=None):
+	def recursively_get_children(self, child_types=None, specifier=None):
 
 		"""
 		This method will recursively scan the profile hierarchy for all enabled profiles of a particular type or types.
@@ -659,41 +975,27 @@ class ProfileTree(object):
 
 		:param child_types: A list of ``ProfileType``\s to scan for, or ``None`` to return all types. Or just a single ``ProfileType``.
 		:param specifier: Start at the specified ``ProfileSpecifier`` in the hierarchy, or at top if ``None``.
-		:param _child_dict: Used for recursion calls only.
 		:return: A list of ``ProfileSpecifier`` objects matching the criteria.
 
 		"""
-		_child_dict = (
-			_child_dict
-			if _child_dict is not None
-			else self.profile_path_map[specifier.resolved_path if specifier else self.root_parent_dir]
-		)
-		out = []
-		for child_path, child_target_dict in _child_dict.items():
-			if child_types is None:
-				out.append(child_path)
-			elif isinstance(child_types, ProfileType):
-				if child_path.classify() == child_types:
-					out.append(child_path)
-			elif child_path.classify() in child_types:
-				out.append(child_path)
-			out += self.recursively_get_children(child_types, child_path, _child_dict=child_target_dict)
-		return out
+		if specifier is None:
+			return self.index.get(child_types)
+		pos = self.index.positions.get(specifier.resolved_path)
+		if pos is None:
+			# a profile that is no longer part of the hierarchy:
+			return ProfileTreeIndex(self.profile_path_map[specifier.resolved_path]).get(child_types)
+		return self.index.get(child_types, pos + 1, self.index.ends[pos])
 
 	def _read_parent(self, parent_dir):
-		fn = os.path.join(parent_dir, "parent")
-		if not os.path.exists(fn):
-			return
-		with open(fn, "r") as f:
-			for line in f.readlines():
-				if len(line) and line[0] == "#":
-					continue
-				elif len(line) == 0:
-					continue
-				yield line.strip()
+		return parent_cache.lines(parent_dir)
 
 
 def getProfileCatalogAndTree(config):
+	if config.warm_profile is not None:
+		# The tree is changed in place when profiles are changed, so it can only be used once:
+		catalog, tree = config.warm_profile
+		config.warm_profile = None
+		return catalog, tree
 	funtoo_repos = all_funtoo_repos(config)
 	catalog = MetaProfileCatalog(config, funtoo_repos)
 	tree = ProfileTree(catalog, "core-kit", config, funtoo_repos)
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+import glob
+import json
+import os
+import sys
+from collections.abc import Mapping
+
+
+class ModuleRegistry(object):
+	"""
+	``ModuleRegistry`` knows which ego modules are installed (``modules/<name>.ego``) and their metadata
+	(``modules-info/<name>.json``), while reading as little as possible: running a module by name only reads that
+	module's metadata.
+
+	Listing all modules, as ``ego help`` does, uses an index file (``module-index.json``) holding the metadata of every
+	module, which is generated at install time. The index records the mtime and size of each file it was built from.
+	It is checked against the files on disk (without parsing them) before use, and rebuilt only if it is stale.
+	"""
+
+	index_version = 1
+
+	def __init__(self, ego_dir):
+		self.ego_dir = ego_dir
+		self.mods_dir = os.path.join(ego_dir, "modules")
+		self.info_dir = os.path.join(ego_dir, "modules-info")
+		self.index_path = os.path.join(ego_dir, "module-index.json")
+		self._info = {}
+		self._index = None
+
+	def module_path(self, name):
+		return os.path.join(self.mods_dir, name + ".ego")
+
+	def info_path(self, name):
+		return os.path.join(self.info_dir, name + ".json")
+
+	def exists(self, name):
+		return "/" not in name and os.path.exists(self.module_path(name))
+
+	def info(self, name):
+		"""Returns the metadata of module ``name``, or an empty dict if it has none."""
+		if name not in self._info:
+			try:
+				with open(self.info_path(name), "r") as f:
+					self._info[name] = json.loads(f.read())
+			except FileNotFoundError:
+				self._info[name] = {}
+		return self._info[name]
+
+	def _scan(self):
+		return sorted(os.path.basename(path)[:-4] for path in glob.glob(os.path.join(self.mods_dir, "*.ego")))
+
+	@staticmethod
+	def _file_signature(path):
+		try:
+			st = os.stat(path)
+		except FileNotFoundError:
+			return None
+		return [st.st_mtime_ns, st.st_size]
+
+	def _signatures(self, name):
+		return [self._file_signature(self.module_path(name)), self._file_signature(self.info_path(name))]
+
+	def build_index(self):
+		modules = {}
+		for name in self._scan():
+			modules[name] = {"files": self._signatures(name), "info": self.info(name)}
+		return {"version": self.index_version, "modules": modules}
+
+	def write_index(self, index=None):
+		from ego.config import atomic_write
+
+		if index is None:
+			index = self.build_index()
+		atomic_write(self.index_path, json.dumps(index, indent=2, sort_keys=True) + "\n")
+		return index
+
+	def load_index(self, verify=True):
+		"""
+		Returns the contents of the index, or None if it is missing or -- when ``verify`` is True -- stale.
+		"""
+		try:
+			with open(self.index_path, "r") as f:
+				index = json.loads(f.read())
+		except (OSError, ValueError):
+			return None
+		if not isinstance(index, dict) or index.get("version") != self.index_version:
+			return None
+		if verify:
+			if list(index["modules"].keys()) != self._scan():
+				return None
+			for name, entry in index["modules"].items():
+				if entry["files"] != self._signatures(name):
+					return None
+		return index
+
+	@property
+	def index(self):
+		if self._index is None:
+			index = self.load_index()
+			if index is None:
+				index = self.build_index()
+				try:
+					self.write_index(index)
+				except OSError:
+					# read-only install; we will just scan again next time.
+					pass
+			for name, entry in index["modules"].items():
+				self._info.setdefault(name, entry["info"])
+			self._index = index
+		return self._index
+
+	def names(self):
+		return list(self.index["modules"].keys())
+
+	def available(self):
+		for name in self.names():
+			yield name, self.info(name)
+
+	def module_for_shortcut(self, exec_name):
+		"""Returns the name of the module that is run by the shortcut command ``exec_name`` (such as ``epro``), or None."""
+
+		def matches(info):
+			return "shortcut" in info and os.path.basename(info["shortcut"]) == exec_name
+
+		# Shortcuts don't change often, so try the index without verifying it first. The module's own metadata is
+		# always read to confirm the match:
+		index = self.load_index(verify=False)
+		if index is not None:
+			for name, entry in index["modules"].items():
+				if matches(entry["info"]) and self.exists(name) and matches(self.info(name)):
+					return name
+		for name, info in self.available():
+			if matches(info):
+				return name
+		return None
+
+
+class ModuleInfoMap(Mapping):
+	"""A read-only ``{module name: metadata}`` mapping backed by a ``ModuleRegistry``, loading metadata on demand."""
+
+	def __init__(self, registry):
+		self.registry = registry
+
+	def __getitem__(self, name):
+		if not self.registry.exists(name):
+			raise KeyError(name)
+		return self.registry.info(name)
+
+	def __contains__(self, name):
+		return isinstance(name, str) and self.registry.exists(name)
+
+	def __iter__(self):
+		return iter(self.registry.names())
+
+	def __len__(self):
+		return len(self.registry.names())
+
+
+if __name__ == "__main__":
+	# Used at install time to generate the module index: python3 -m ego.registry <ego install dir>
+	registry = ModuleRegistry(sys.argv[1] if len(sys.argv) > 1 else ".")
+	index = registry.write_index()
+	print("Wrote index of %s modules to %s." % (len(index["modules"]), registry.index_path))
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+import os
+import selectors
+import signal
+import sys
+import traceback
+from collections import OrderedDict
+
+from cmdtools import timings
+from ego.output import Color
+
+
+class ForkedWorkerPool:
+	"""
+	``ForkedWorkerPool`` runs Python callables in forked child processes, with at most ``jobs`` children running at
+	once. This is used by ``ego sync`` to synchronize independent kits concurrently.
+
+	Each job is submitted with a label (such as a kit name) and a callable. The child process calls ``pre_exec`` (if
+	specified -- this is where privileges get dropped) and then the callable. Like ``drop_perms_and_run()`` in the sync
+	module, a truthy return value results in an exit code of 0 and a falsy one in an exit code of 1.
+
+	When ``label_output`` is True, the stdout and stderr of each child (including the output of any commands it spawns)
+	are captured through a pipe and written to ``outfile`` one line at a time, prefixed with the job's label, so that
+	the output of concurrent jobs stays readable.
+
+	Timings recorded by the child (see ``cmdtools.Timings``) are sent back to the parent through a second pipe, so that
+	commands run by workers show up in the parent's timing report.
+
+	If specified, ``on_complete`` is called in the parent with the label and wait status of each job as soon as it
+	finishes, so that progress can be recorded even if the pool is interrupted.
+
+	``run()`` returns an ``OrderedDict`` mapping each label, in submission order, to the raw wait status of its child
+	as returned by ``os.waitpid()``.
+	"""
+
+	def __init__(self, jobs=1, pre_exec=None, label_output=True, outfile=None, on_complete=None):
+		self.jobs = max(1, jobs)
+		self.pre_exec = pre_exec
+		self.on_complete = on_complete
+		self.label_output = label_output
+		self.outfile = outfile if outfile is not None else sys.stdout
+		self.pending = []
+		self.results = OrderedDict()
+		self._label_width = 0
+
+	def submit(self, label, fn):
+		self.pending.append((label, fn))
+		self.results[label] = None
+		self._label_width = max(self._label_width, len(label))
+
+	def _child(self, fn, write_fd, timings_fd, mark):
+		exit_code = 1
+		try:
+			if write_fd is not None:
+				os.dup2(write_fd, 1)
+				os.dup2(write_fd, 2)
+				os.close(write_fd)
+				# sys.stdout and sys.stderr may have been replaced, so point them at the pipe too:
+				sys.stdout = open(1, "w", buffering=1, closefd=False)
+				sys.stderr = open(2, "w", buffering=1, closefd=False)
+			if self.pre_exec is not None:
+				self.pre_exec()
+			exit_code = 0 if fn() else 1
+		except SystemExit as e:
+			if e.code is None:
+				exit_code = 0
+			elif isinstance(e.code, int):
+				exit_code = e.code
+			else:
+				sys.stderr.write(str(e.code) + "\n")
+				exit_code = 1
+		except BaseException:
+			traceback.print_exc()
+			exit_code = 1
+		finally:
+			try:
+				timings.send(timings_fd, mark)
+				sys.stdout.flush()
+				sys.stderr.flush()
+			finally:
+				os._exit(exit_code)
+
+	def _start(self, label, fn):
+		read_fd = write_fd = None
+		if self.label_output:
+			read_fd, write_fd = os.pipe()
+		timings_read_fd, timings_write_fd = os.pipe()
+		mark = timings.mark()
+		sys.stdout.flush()
+		sys.stderr.flush()
+		pid = os.fork()
+		if pid == 0:
+			os.close(timings_read_fd)
+			if read_fd is not None:
+				os.close(read_fd)
+			self._child(fn, write_fd, timings_write_fd, mark)
+		os.close(timings_write_fd)
+		if write_fd is not None:
+			os.close(write_fd)
+		return pid, read_fd, timings_read_fd
+
+	def _write_line(self, label, line):
+		prefix = Color.darkcyan(label.ljust(self._label_width))
+		self.outfile.write("%s | %s\n" % (prefix, line.decode(errors="replace").rstrip("\n")))
+		self.outfile.flush()
+
+	def run(self):
+		# pid -> (label, set of pipes still open). A child is reaped once all of its pipes are at EOF.
+		running = {}
+		buffers = {}
+		timing_fds = set()
+		selector = selectors.DefaultSelector()
+		try:
+			while self.pending or running:
+				while self.pending and len(running) < self.jobs:
+					label, fn = self.pending.pop(0)
+					pid, read_fd, timings_fd = self._start(label, fn)
+					running[pid] = (label, set())
+					timing_fds.add(timings_fd)
+					for fd in [read_fd, timings_fd]:
+						if fd is not None:
+							running[pid][1].add(fd)
+							buffers[fd] = b""
+							selector.register(fd, selectors.EVENT_READ, pid)
+				for key, events in selector.select():
+					fd = key.fd
+					pid = key.data
+					label, open_fds = running[pid]
+					chunk = os.read(fd, 65536)
+					if chunk:
+						data = buffers[fd] + chunk
+						if fd in timing_fds:
+							buffers[fd] = data
+						else:
+							lines = data.split(b"\n")
+							buffers[fd] = lines.pop()
+							for line in lines:
+								self._write_line(label, line)
+						continue
+					# EOF:
+					if fd in timing_fds:
+						timings.receive_lines(buffers[fd].decode(errors="replace").splitlines())
+						timing_fds.discard(fd)
+					elif buffers[fd]:
+						self._write_line(label, buffers[fd])
+					selector.unregister(fd)
+					os.close(fd)
+					del buffers[fd]
+					open_fds.discard(fd)
+					if not open_fds:
+						# the child has exited (or closed its pipes), so reap it:
+						del running[pid]
+						self.results[label] = os.waitpid(pid, 0)[1]
+						if self.on_complete is not None:
+							self.on_complete(label, self.results[label])
+		except BaseException:
+			for pid in running:
+				try:
+					os.kill(pid, signal.SIGTERM)
+					os.waitpid(pid, 0)
+				except OSError:
+					pass
+			raise
+		finally:
+			selector.close()
+		return self.results
+
+# vim: ts=4 sw=4 noet
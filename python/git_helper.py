@@ -1,27 +1,81 @@
 #!/usr/bin/python3
 
+import fcntl
 import os
-from cmdtools import run_statusoutput, run
+from contextlib import contextmanager
+from cmdtools import run, Task
+from git_reader import GitReader
 from pathlib import Path
 from datetime import datetime
 from ego.output import Output
 
 
 class GitHelper(object):
+
+	# Name of the file, inside .git, that records the state of a kit after it was last successfully synced:
+	sync_stamp = "ego-sync-stamp"
+
 	def __init__(self, module, root, quiet=False):
 		self.module = module
 		self.root = root
 		self.quiet = quiet
 
+	@property
+	def reader(self):
+		if not hasattr(self, "_reader"):
+			self._reader = GitReader(self.root)
+		return self._reader
+
+	@property
+	def git_dir(self):
+		return self.reader.git_dir
+
+	def _index_signature(self):
+		try:
+			st = os.stat(os.path.join(self.git_dir, "index"))
+		except FileNotFoundError:
+			return None
+		return "%s %s" % (st.st_mtime_ns, st.st_size)
+
+	def is_aligned(self, branch, sha1):
+		"""
+		Cheap check -- without running git -- to determine whether this repository is already checked out at ``sha1``
+		with a clean worktree. HEAD must point to ``sha1``, either on ``branch`` or detached, no git operation may be
+		in progress, and the git index must not have changed since ``write_sync_stamp()`` was last called for
+		``sha1``. Changes made to the worktree without touching the index are not detected.
+		"""
+		head_sha1, head_ref = self.reader.resolve("HEAD")
+		if head_sha1 != sha1:
+			return False
+		if head_ref is not None and head_ref != "refs/heads/%s" % branch:
+			return False
+		for in_progress in ["index.lock", "MERGE_HEAD", "CHERRY_PICK_HEAD", "rebase-merge", "rebase-apply"]:
+			if os.path.exists(os.path.join(self.git_dir, in_progress)):
+				return False
+		try:
+			with open(os.path.join(self.git_dir, self.sync_stamp), "r") as f:
+				stamp = f.read().split("\n")
+		except FileNotFoundError:
+			return False
+		return len(stamp) >= 2 and stamp[0] == sha1 and stamp[1] == self._index_signature()
+
+	def write_sync_stamp(self, sha1):
+		"""Records that the repository has been synced to ``sha1``, for use by ``is_aligned()``."""
+		try:
+			with open(os.path.join(self.git_dir, self.sync_stamp), "w") as f:
+				f.write("%s\n%s\n" % (sha1, self._index_signature()))
+		except OSError:
+			pass
+
 	def localBranches(self):
-		if os.path.exists(sedlf.root):
-			retval, out = run_statusoutput('git -C %s for-each-ref --format="(refname)" refs/heads' % self.root)
-			if retval == 0:
-				for ref in out.split():
-					yield ref.split("/")[-1]
+		for ref in self.reader.refs("refs/heads/"):
+			yield ref[len("refs/heads/") :]
 
 	def localBranchExists(self, branch):
-		return not run("git -C %s show-ref --verify --quiet refs/heads/%s" % (self.root, branch), quiet=self.quiet)
+		return self.reader.ref_exists("refs/heads/%s" % branch)
+
+	def hasCommit(self, sha1):
+		return self.reader.has_object(sha1)
 
 	def isReadOnly(self):
 		try:
@@ -46,13 +100,116 @@ class GitHelper(object):
 			quiet=self.quiet,
 		)
 
-	def clone(self, url, branch, depth: int = None):
+	def isShallow(self):
+		return os.path.exists(os.path.join(self.git_dir, "shallow"))
+
+	def fetchCommit(self, sha1, remote="origin", depth: int = None):
+		"""
+		Fetches exactly the commit ``sha1`` from ``remote``. This requires the server to allow requests for commits
+		that are not advertised as refs, which is the case for git's protocol v2 and for servers configured with
+		``uploadpack.allowReachableSHA1InWant``. ``depth`` is only honored for shallow repositories, so that
+		repositories with full history are never made shallow.
+		"""
+		self.readOnlyCheck()
+		if depth is not None and depth != 0 and self.isShallow():
+			depth_str = "--depth=%s" % depth
+		else:
+			depth_str = ""
+		return run("git -C %s fetch --no-tags %s %s %s" % (self.root, depth_str, remote, sha1), quiet=self.quiet)
+
+	def forceCheckout(self, branch, sha1):
+		"""Points ``branch`` at ``sha1`` and force-checks it out, discarding any local changes to tracked files."""
+		retval = run("git -C %s checkout -q -f -B %s %s" % (self.root, branch, sha1), quiet=self.quiet)
+		return retval == 0
+
+	def syncToCommit(self, branch, sha1, remote="origin", depth: int = None):
+		"""
+		Brings the repository to commit ``sha1`` on ``branch``, fetching it from ``remote`` only if it is not already
+		available locally.
+
+		:return: True on success; False if the commit could not be fetched or checked out, in which case the caller
+		  should fall back to syncing the branch.
+		"""
+		if not self.hasCommit(sha1):
+			if self.fetchCommit(sha1, remote=remote, depth=depth) != 0 or not self.hasCommit(sha1):
+				return False
+		return self.forceCheckout(branch, sha1)
+
+	def clone(self, url, branch, depth: int = None, reference=None):
 		if depth is not None and depth != 0:
 			depth_str = "--depth=%s" % depth
 		else:
 			depth_str = ""
+		if reference is not None:
+			depth_str += " --reference-if-able %s" % reference
 		return run("git clone -b %s %s --single-branch %s %s" % (branch, depth_str, url, self.root), quiet=self.quiet)
 
+	def initWithRemote(self, url, branch, remote="origin"):
+		"""Creates an empty repository whose ``remote`` tracks only ``branch`` of ``url``, like ``clone --single-branch``."""
+		retval = run("git init -q %s" % self.root, quiet=self.quiet)
+		if retval != 0:
+			return retval
+		return run("git -C %s remote add -t %s %s %s" % (self.root, branch, remote, url), quiet=self.quiet)
+
+	def shallowCommits(self):
+		"""Returns the commits at the boundary of a shallow repository's history (an empty list if it isn't shallow.)"""
+		try:
+			with open(os.path.join(self.git_dir, "shallow"), "r") as f:
+				return f.read().split()
+		except FileNotFoundError:
+			return []
+
+	def createBundleTask(self, path, branch):
+		"""Returns a ``Task`` that writes a git bundle of ``branch`` to ``path``, to be run by an ``AsyncTaskRunner``."""
+		return Task(["git", "-C", self.root, "bundle", "create", "-q", path, "refs/heads/%s" % branch])
+
+	def fetchBundle(self, path, branch, shallow=None):
+		"""
+		Fetches ``branch`` from the git bundle at ``path`` into FETCH_HEAD.
+
+		A bundle created from a shallow repository lacks the history behind that repository's shallow boundary, so git
+		can only fetch it into a repository that either has that history or is shallow at the same boundary. If the
+		bundle came from a shallow repository, pass its boundary commits as ``shallow``; those we don't already have
+		are added to our own shallow boundary before fetching.
+		"""
+		self.readOnlyCheck()
+		if shallow:
+			ours = self.shallowCommits()
+			missing = [sha1 for sha1 in shallow if sha1 not in ours and not self.hasCommit(sha1)]
+			if missing:
+				with open(os.path.join(self.git_dir, "shallow"), "a") as f:
+					f.write("".join(sha1 + "\n" for sha1 in missing))
+		return run("git -C %s fetch -q --no-tags %s refs/heads/%s" % (self.root, path, branch), quiet=self.quiet)
+
+	def linkAlternates(self, objects_dir):
+		"""
+		Adds ``objects_dir`` to this repository's ``objects/info/alternates``, so that objects stored there do not
+		need to be stored (or downloaded) again. Returns True if the file was changed.
+		"""
+		alt_path = os.path.join(self.git_dir, "objects", "info", "alternates")
+		try:
+			with open(alt_path, "r") as f:
+				alternates = f.read().split()
+		except FileNotFoundError:
+			alternates = []
+		if objects_dir in alternates:
+			return False
+		os.makedirs(os.path.dirname(alt_path), exist_ok=True)
+		with open(alt_path, "a") as f:
+			f.write(objects_dir + "\n")
+		return True
+
+	def repack(self, options=None):
+		options = options or []
+		self.readOnlyCheck()
+		opts = " ".join(options)
+		return run("git -C %s repack %s" % (self.root, opts), quiet=self.quiet)
+
+	def repackTask(self, options=None):
+		"""Returns a ``Task`` that repacks the repository, to be run by an ``AsyncTaskRunner``."""
+		self.readOnlyCheck()
+		return Task(["git", "-C", self.root, "repack"] + list(options or []))
+
 	def pull(self, options=None):
 		options = options or []
 		self.readOnlyCheck()
@@ -75,7 +232,7 @@ class GitHelper(object):
 		return os.path.exists(self.root)
 
 	def is_git_repo(self):
-		return os.path.exists(os.path.join(self.root, ".git"))
+		return self.reader.is_repo()
 
 	def checkout(self, branch="master", origin=None):
 		if origin is not None:
@@ -87,7 +244,7 @@ class GitHelper(object):
 
 	def last_sync(self):
 		"""Returns datetime of last sync, or None if not a git repo."""
-		check_f = self.root + "/.git/FETCH_HEAD"
+		check_f = os.path.join(self.git_dir, "FETCH_HEAD")
 		try:
 			return datetime.fromtimestamp(os.path.getmtime(check_f))
 		except FileNotFoundError:
@@ -95,8 +252,63 @@ class GitHelper(object):
 
 	@property
 	def commitID(self):
-		retval, out = run_statusoutput("git -C %s rev-parse HEAD" % self.root)
-		if retval == 0:
-			return out.strip()
-		else:
-			return None
+		return self.reader.head()
+
+
+class SharedObjectStore(object):
+	"""
+	``SharedObjectStore`` is a bare git repository that holds objects on behalf of several clones (kits), which link to
+	it through ``objects/info/alternates``. History that is already on the machine -- in another kit, or another branch
+	or release of the same kit -- then does not need to be downloaded or stored again.
+
+	Each clone publishes its branches into the store as ``refs/kits/<name>/<branch>``. These refs keep the objects the
+	clones rely on reachable, so that garbage-collecting the store never removes anything a clone still needs.
+
+	Git refuses to use shallow repositories as references, so only clones with complete history are published, and the
+	store itself is never shallow.
+	"""
+
+	def __init__(self, root, quiet=False):
+		self.root = root
+		self.quiet = quiet
+
+	@property
+	def objects_dir(self):
+		return os.path.join(self.root, "objects")
+
+	def exists(self):
+		return os.path.isfile(os.path.join(self.root, "HEAD"))
+
+	def create(self):
+		if self.exists():
+			return 0
+		os.makedirs(self.root, exist_ok=True)
+		return run("git init -q --bare %s" % self.root, quiet=self.quiet)
+
+	@contextmanager
+	def lock(self, exclusive=False):
+		"""
+		Syncs hold a shared lock while they use the store; maintenance holds an exclusive lock so that objects are
+		never repacked or pruned while a clone is in the middle of fetching.
+		"""
+		with open(os.path.join(self.root, "ego.lock"), "a") as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+			pid = os.getpid()
+			try:
+				yield
+			finally:
+				# a forked child shares the lock with us, so it must not release it if it leaves this block:
+				if os.getpid() == pid:
+					fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+	def publish(self, name, repo: GitHelper):
+		"""Copies the branches of ``repo`` into the store. Returns 0 on success, or non-zero if not possible."""
+		if repo.isShallow():
+			return 1
+		return run(
+			"git -C %s fetch -q --no-tags %s +refs/heads/*:refs/kits/%s/*" % (self.root, repo.root, name), quiet=self.quiet
+		)
+
+	def gc(self):
+		# Use git's default prune expiry, so that objects written by a concurrent fetch are never pruned.
+		return run("git -C %s gc --quiet" % self.root, quiet=self.quiet)
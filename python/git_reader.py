@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+import binascii
+import glob
+import os
+import struct
+
+
+class GitReader(object):
+	"""
+	``GitReader`` answers read-only questions about a git repository -- what HEAD points to, which refs exist, whether
+	an object is present -- by reading the repository's files directly instead of starting a ``git`` process.
+
+	It understands:
+
+	* HEAD and other symbolic refs (``ref: refs/heads/master``).
+	* Loose refs under ``refs/`` and refs stored in ``packed-refs``.
+	* Loose objects and objects stored in packs (version 1 and 2 pack indexes).
+	* Object stores linked through ``objects/info/alternates``.
+	* Work trees whose ``.git`` is a file pointing elsewhere (``gitdir: ...``), and bare repositories.
+
+	This is not a general-purpose git implementation -- it never writes anything, and it does not decompress objects.
+	"""
+
+	pack_idx_magic = b"\377tOc"
+
+	def __init__(self, root):
+		self.root = root
+		self._git_dir = None
+		self._packed_refs = None
+		self._packed_refs_sig = None
+		self._pack_indexes = {}
+
+	@property
+	def git_dir(self):
+		if self._git_dir is None:
+			dot_git = os.path.join(self.root, ".git")
+			if os.path.isdir(dot_git):
+				self._git_dir = dot_git
+			elif os.path.isfile(dot_git):
+				with open(dot_git, "r") as f:
+					contents = f.read().strip()
+				if contents.startswith("gitdir:"):
+					self._git_dir = os.path.normpath(os.path.join(self.root, contents[7:].strip()))
+				else:
+					self._git_dir = dot_git
+			elif os.path.isfile(os.path.join(self.root, "HEAD")) and os.path.isdir(os.path.join(self.root, "objects")):
+				# bare repository
+				self._git_dir = self.root
+			else:
+				self._git_dir = dot_git
+		return self._git_dir
+
+	@property
+	def common_dir(self):
+		"""For linked work trees, refs and objects live in the 'common' git directory."""
+		try:
+			with open(os.path.join(self.git_dir, "commondir"), "r") as f:
+				return os.path.normpath(os.path.join(self.git_dir, f.read().strip()))
+		except (FileNotFoundError, NotADirectoryError):
+			return self.git_dir
+
+	def is_repo(self):
+		return os.path.isfile(os.path.join(self.git_dir, "HEAD"))
+
+	# REFS
+
+	def _ref_path(self, ref):
+		if ref == "HEAD" or not ref.startswith("refs/"):
+			# per-worktree refs such as HEAD, FETCH_HEAD, ORIG_HEAD:
+			return os.path.join(self.git_dir, ref)
+		return os.path.join(self.common_dir, ref)
+
+	def packed_refs(self):
+		"""
+		Returns a dict mapping ref names to SHA1s for all refs in ``packed-refs``. The file is only re-parsed when it
+		changes on disk.
+		"""
+		path = os.path.join(self.common_dir, "packed-refs")
+		try:
+			st = os.stat(path)
+		except (FileNotFoundError, NotADirectoryError):
+			return {}
+		sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+		if self._packed_refs is None or sig != self._packed_refs_sig:
+			refs = {}
+			with open(path, "r") as f:
+				for line in f:
+					if not line or line[0] in "#^":
+						continue
+					parts = line.split()
+					if len(parts) == 2:
+						refs[parts[1]] = parts[0]
+			self._packed_refs = refs
+			self._packed_refs_sig = sig
+		return self._packed_refs
+
+	def resolve(self, ref, max_depth=5):
+		"""
+		Resolves a ref such as ``HEAD`` or ``refs/heads/master`` to a SHA1, following symbolic refs and consulting loose
+		refs before ``packed-refs``.
+
+		:param ref: name of the ref to resolve.
+		:return: a tuple of the SHA1 (or None if the ref could not be resolved) and the name of the last symbolic ref
+		  followed (or None if ``ref`` does not point to another ref).
+		"""
+		symref = None
+		for _ in range(max_depth):
+			try:
+				with open(self._ref_path(ref), "r") as f:
+					contents = f.read().strip()
+			except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+				return self.packed_refs().get(ref), symref
+			if contents.startswith("ref:"):
+				ref = symref = contents[4:].strip()
+				continue
+			return contents.split()[0] if contents else None, symref
+		return None, symref
+
+	def head(self):
+		"""Returns the SHA1 that HEAD points to, or None if the repository has no commits (or does not exist.)"""
+		return self.resolve("HEAD")[0]
+
+	def symbolic_head(self):
+		"""Returns the ref HEAD points to, such as ``refs/heads/master``, or None if HEAD is detached."""
+		return self.resolve("HEAD", max_depth=1)[1]
+
+	def ref_exists(self, ref):
+		return self.resolve(ref)[0] is not None
+
+	def refs(self, prefix="refs/heads/"):
+		"""Returns a sorted list of all ref names starting with ``prefix``, loose or packed."""
+		names = set(name for name in self.packed_refs() if name.startswith(prefix))
+		base = os.path.join(self.common_dir, prefix)
+		for dirpath, dirnames, filenames in os.walk(base):
+			for filename in filenames:
+				if filename.endswith(".lock"):
+					continue
+				names.add(prefix + os.path.relpath(os.path.join(dirpath, filename), base).replace(os.sep, "/"))
+		return sorted(names)
+
+	# OBJECTS
+
+	def object_dirs(self):
+		"""Returns this repository's object directory, followed by any alternate object directories."""
+		out = []
+		todo = [os.path.join(self.common_dir, "objects")]
+		while todo and len(out) < 10:
+			obj_dir = os.path.normpath(todo.pop(0))
+			if obj_dir in out:
+				continue
+			out.append(obj_dir)
+			try:
+				with open(os.path.join(obj_dir, "info", "alternates"), "r") as f:
+					for line in f:
+						line = line.strip()
+						if line and not line.startswith("#"):
+							todo.append(os.path.join(obj_dir, line))
+			except (FileNotFoundError, NotADirectoryError):
+				pass
+		return out
+
+	def _pack_index(self, idx_path):
+		"""Returns the fanout table and raw SHA1 table of a pack index, memoized by path."""
+		if idx_path not in self._pack_indexes:
+			with open(idx_path, "rb") as f:
+				data = f.read()
+			if data[:4] == self.pack_idx_magic:
+				fanout = struct.unpack(">256I", data[8 : 8 + 1024])
+				shas = data[8 + 1024 : 8 + 1024 + fanout[255] * 20]
+				stride = 20
+			else:
+				fanout = struct.unpack(">256I", data[:1024])
+				# version 1 entries are a 4-byte offset followed by the SHA1:
+				shas = data[1024 + 4 : 1024 + fanout[255] * 24]
+				stride = 24
+			self._pack_indexes[idx_path] = (fanout, shas, stride)
+		return self._pack_indexes[idx_path]
+
+	def _pack_contains(self, idx_path, raw_sha1):
+		fanout, shas, stride = self._pack_index(idx_path)
+		first = raw_sha1[0]
+		lo = fanout[first - 1] if first > 0 else 0
+		hi = fanout[first]
+		while lo < hi:
+			mid = (lo + hi) // 2
+			candidate = shas[mid * stride : mid * stride + 20]
+			if candidate == raw_sha1:
+				return True
+			elif candidate < raw_sha1:
+				lo = mid + 1
+			else:
+				hi = mid
+		return False
+
+	def has_object(self, sha1):
+		"""Returns True if the object ``sha1`` is available, either loose or packed, in this or an alternate store."""
+		try:
+			raw_sha1 = binascii.unhexlify(sha1)
+		except (binascii.Error, TypeError):
+			return False
+		if len(raw_sha1) != 20:
+			return False
+		sha1 = sha1.lower()
+		for obj_dir in self.object_dirs():
+			if os.path.exists(os.path.join(obj_dir, sha1[:2], sha1[2:])):
+				return True
+			for idx_path in glob.glob(os.path.join(obj_dir, "pack", "*.idx")):
+				if self._pack_contains(idx_path, raw_sha1):
+					return True
+		return False
+
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cmdtools import AsyncTaskRunner, Task, TaskList, Timings, run, timings
+
+
+class TimingsTest(unittest.TestCase):
+	def test_commands_are_labelled_with_phase(self):
+		mark = timings.mark()
+		run("true")
+		with timings.phase("kits"):
+			with timings.phase("kit", kit="core-kit"):
+				run("false")
+			run("true")
+		records = timings.records[mark:]
+		commands = [r for r in records if r["type"] == "command"]
+		self.assertEqual([(r["phase"], r["kit"], r["returncode"]) for r in commands], [(None, None, 0), ("kit", "core-kit", 1), ("kits", None, 0)])
+		phases = [r for r in records if r["type"] == "phase"]
+		self.assertEqual([(r["phase"], r["kit"]) for r in phases], [("kit", "core-kit"), ("kits", None)])
+		self.assertGreaterEqual(phases[1]["duration"], phases[0]["duration"])
+		self.assertEqual(timings.labels, {"phase": None, "kit": None})
+
+	def test_send_and_receive(self):
+		child = Timings()
+		with child.phase("meta-repo"):
+			pass
+		mark = child.mark()
+		with child.phase("kits"):
+			pass
+		read_fd, write_fd = os.pipe()
+		child.send(write_fd, mark)
+		parent = Timings()
+		parent.receive(read_fd)
+		self.assertEqual([r["phase"] for r in parent.phases()], ["kits"])
+
+
+class AsyncTaskRunnerTest(unittest.TestCase):
+	def test_output_and_exit_code(self):
+		lines = []
+		runner = AsyncTaskRunner(on_line=lambda task, stream, line: lines.append((stream, line)))
+		[[result]] = runner.run([Task(["sh", "-c", "echo one; echo two >&2; echo three; exit 3"])])
+		self.assertEqual(result.returncode, 3)
+		self.assertFalse(result.success)
+		self.assertEqual(result.stdout, ["one\n", "three\n"])
+		self.assertEqual(result.stderr, ["two\n"])
+		self.assertEqual(result.output, "one\nthree\n")
+		self.assertGreaterEqual(result.duration, 0)
+		self.assertEqual(sorted(lines), [("stderr", "two\n"), ("stdout", "one\n"), ("stdout", "three\n")])
+
+	def running_tasks(self, jobs, script):
+		"""
+		Runs four tasks, each of which creates a file named after it (``$i``) in directory ``$d`` and then runs
+		``script``, which prints ``$n``: the number of files, as last updated by ``count``. Returns the largest number
+		printed, which is how many tasks were running at once.
+		"""
+		with tempfile.TemporaryDirectory() as d:
+			setup = 'i=%s; d=' + d + '; touch $d/$i; count() { n=$(ls $d | wc -l); }; count; '
+			results = AsyncTaskRunner(jobs=jobs).run([Task(["sh", "-c", setup % i + script], timeout=30) for i in range(4)])
+		self.assertTrue(all(result.success for [result] in results))
+		return max(int(result.output) for [result] in results)
+
+	def test_concurrency_limit(self):
+		# all four tasks run at once, as each of them waits for the others to start:
+		self.assertEqual(self.running_tasks(4, 'while [ $n -lt 4 ]; do sleep 0.01; count; done; echo $n'), 4)
+		# never more than two tasks run at once:
+		self.assertLessEqual(self.running_tasks(2, 'echo $n; sleep 0.05; rm $d/$i'), 2)
+
+	def test_runs_again(self):
+		# each run has its own event loop, and so needs its own semaphore:
+		runner = AsyncTaskRunner(jobs=1)
+		for i in range(2):
+			results = runner.run([Task(["sleep", "0.05"]), Task(["sleep", "0.05"])])
+			self.assertTrue(all(result.success for [result] in results))
+
+	def test_chains(self):
+		t1 = Task(["true"])
+		t1.nextTask = Task(["false"])
+		t1.nextTask.nextTask = Task(["true"])
+		tl = TaskList()
+		tl.append(Task(["false"], abortOnError=False))
+		tl.append(Task(["true"]))
+		results = AsyncTaskRunner().run([t1, tl])
+		self.assertEqual([r.returncode for r in results[0]], [0, 1])
+		self.assertEqual([r.returncode for r in results[1]], [1, 0])
+		self.assertEqual(tl.returncode, 0)
+
+	def test_timeout(self):
+		runner = AsyncTaskRunner(timeout=5)
+		start = time.monotonic()
+		[[slow], [fast]] = runner.run([Task(["sleep", "60"], timeout=0.2), Task(["echo", "fast"])])
+		self.assertTrue(slow.timed_out)
+		self.assertNotEqual(slow.returncode, 0)
+		self.assertFalse(fast.timed_out)
+		self.assertTrue(fast.success)
+		# killed long before it would have finished:
+		self.assertLess(time.monotonic() - start, 30)
+
+	def test_cancel(self):
+		runner = AsyncTaskRunner()
+		task = Task(["sleep", "60"])
+
+		async def main():
+			chain = asyncio.ensure_future(runner.run_chain([task]))
+			await asyncio.sleep(0.2)
+			chain.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await chain
+
+		start = time.monotonic()
+		asyncio.run(main())
+		self.assertFalse(task.running)
+		self.assertLess(task.returncode, 0)
+		self.assertLess(time.monotonic() - start, 30)
+
+	def test_missing_command(self):
+		[[result]] = AsyncTaskRunner().run([Task(["/nonexistent/command"])])
+		self.assertEqual(result.returncode, 127)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import configparser
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.completion import CompletionIndex
+from ego.config import EgoConfig
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CompletionIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = self.tmp.name
+		meta_repo = os.path.join(self.root, "var/git/meta-repo")
+		os.makedirs(os.path.join(meta_repo, "metadata"))
+		with open(os.path.join(meta_repo, "metadata/kit-sha1.json"), "w") as f:
+			f.write(json.dumps({"core-kit": {"1.4-prime": "a" * 40, "next": "b" * 40}, "xorg-kit": {"1.20-release": "c" * 40}}))
+		os.makedirs(os.path.join(meta_repo, "kits/core-kit"))
+		os.symlink(os.path.join(TESTS_DIR, "profiles"), os.path.join(meta_repo, "kits/core-kit/profiles"))
+		os.makedirs(os.path.join(self.root, "etc/portage/repos.conf"))
+		with open(os.path.join(self.root, "etc/portage/repos.conf/ego-core-kit"), "w") as f:
+			f.write("[core-kit]\nlocation = /var/git/meta-repo/kits/core-kit\n")
+		settings = configparser.ConfigParser()
+		settings.read_string("[global]\ncache_dir = %s\n" % os.path.join(self.root, "cache"))
+		install_path = os.path.join(TESTS_DIR, "../..")
+		self.config = EgoConfig(settings, os.path.join(self.root, "ego.conf"), root_path=self.root, install_path=install_path)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def read_index(self):
+		entries = {}
+		with open(self.config.completion_index, "r") as f:
+			for line in f:
+				key, word = line.rstrip("\n").split(" ")
+				entries.setdefault(key, []).append(word)
+		return entries
+
+	def test_write(self):
+		self.assertTrue(CompletionIndex(self.config, arch="x86-64bit").write())
+		entries = self.read_index()
+		self.assertIn("profile", entries["module"])
+		self.assertIn("sync", entries["module"])
+		self.assertTrue({"show", "get", "list", "flavor", "mix-ins", "mix-in", "update"} <= set(entries["action/profile"]))
+		self.assertEqual(sorted(entries["action/config"]), ["get", "set"])
+		self.assertNotIn("action/sync", entries)
+		self.assertEqual(entries["kit"], ["core-kit", "xorg-kit"])
+		self.assertEqual(entries["branch/core-kit"], ["1.4-prime", "next"])
+		self.assertIn("desktop", entries["profile/flavor"])
+		self.assertIn("X", entries["profile/mix-ins"])
+		self.assertIn("x86-64bit", entries["profile/arch"])
+		self.assertIn("amd64-jaguar", entries["profile/subarch/x86-64bit"])
+		self.assertNotIn("profile/subarch", entries)
+		self.assertEqual(entries["current/arch"], ["x86-64bit"])
+
+	def test_write_without_repos(self):
+		# before the first sync, only modules are known:
+		for fn in os.listdir(os.path.join(self.root, "etc/portage/repos.conf")):
+			os.unlink(os.path.join(self.root, "etc/portage/repos.conf", fn))
+		os.rmdir(os.path.join(self.root, "etc/portage/repos.conf"))
+		os.unlink(os.path.join(self.root, "var/git/meta-repo/metadata/kit-sha1.json"))
+		self.assertTrue(CompletionIndex(self.config).write())
+		entries = self.read_index()
+		self.assertIn("profile", entries["module"])
+		self.assertNotIn("kit", entries)
+		self.assertNotIn("current/arch", entries)
+
+
+if __name__ == "__main__":
+	unittest.main()
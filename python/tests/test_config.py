@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+import configparser
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.config import EgoConfig, ResolvedKitTable, atomic_write, metadata_cache
+from test_git_helper import git, make_repo
+
+
+class MetadataCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		settings = configparser.ConfigParser()
+		settings.read_dict({"global": {"release": "1.4"}})
+		self.config = EgoConfig(settings, os.path.join(self.tmp.name, "ego.conf"), root_path=self.tmp.name, install_path=self.tmp.name)
+		self.metadata = os.path.join(self.config.meta_repo_root, "metadata")
+		os.makedirs(self.metadata)
+		self.write("version", {"version": 10})
+		self.write(
+			"kit-info",
+			{
+				"kit_order": ["core-kit", "xorg-kit"],
+				"release_defs": {"core-kit": ["1.4-prime"], "xorg-kit": ["1.4-prime"]},
+				"kit_settings": {"core-kit": {"default": "1.4-prime"}, "xorg-kit": {"default": "1.4-prime"}},
+			},
+		)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def write(self, fn, data):
+		path = os.path.join(self.metadata, fn + ".json")
+		with open(path + ".new", "w") as f:
+			json.dump(data, f)
+		os.replace(path + ".new", path)
+
+	def test_parsed_once(self):
+		misses = metadata_cache.misses
+		self.assertEqual(list(self.config.all_kit_names_in_release), ["core-kit", "xorg-kit"])
+		self.assertEqual(self.config.get_configured_kit("core-kit"), ("1.4-prime", "1.4-prime"))
+		self.assertEqual(self.config.metadata_version, 10)
+		self.assertEqual(metadata_cache.misses - misses, 2)
+		hits = metadata_cache.hits
+		self.assertIs(self.config.kit_info_metadata, self.config.kit_info_metadata)
+		self.assertEqual(metadata_cache.hits - hits, 2)
+
+	def test_invalidated_when_changed(self):
+		self.assertEqual(self.config.metadata_version, 10)
+		self.write("version", {"version": 11})
+		self.assertEqual(self.config.metadata_version, 11)
+
+	def test_missing_file(self):
+		self.assertEqual(self.config.kit_sha1_metadata, {})
+
+	def new_process(self):
+		# as far as metadata is concerned, a new ego process is a new EgoConfig and an empty cache:
+		metadata_cache.clear()
+		settings = configparser.ConfigParser()
+		settings.read_dict({"global": {"release": "1.4"}})
+		return EgoConfig(settings, os.path.join(self.tmp.name, "ego.conf"), root_path=self.tmp.name, install_path=self.tmp.name)
+
+	def test_snapshot(self):
+		make_repo(self.config.meta_repo_root)
+		self.config.metadata_snapshot.write()
+		self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "var/cache/ego/metadata.marshal")))
+
+		config = self.new_process()
+		misses = metadata_cache.misses
+		self.assertEqual(list(config.all_kit_names_in_release), ["core-kit", "xorg-kit"])
+		self.assertEqual(config.kit_sha1_metadata, {})
+		self.assertEqual(metadata_cache.misses, misses)
+		self.assertEqual(list(config.kit_info_metadata.keys()), ["kit_order", "release_defs", "kit_settings"])
+
+		# changed metadata, or a different meta-repo commit, make the snapshot invalid:
+		self.write("version", {"version": 11})
+		config = self.new_process()
+		self.assertEqual(config.metadata_version, 11)
+		self.assertFalse(config.metadata_snapshot.load())
+		self.config.metadata_snapshot.write()
+		self.assertTrue(self.new_process().metadata_snapshot.load())
+		git(self.config.meta_repo_root, "commit", "-q", "--allow-empty", "-m", "new")
+		self.assertFalse(self.new_process().metadata_snapshot.load())
+
+
+class ResolvedKitTableTest(unittest.TestCase):
+	kit_info = {
+		"kit_order": {"1.3-release": ["core-kit", "xorg-kit", "nokit"], "1.4-release": ["core-kit", "nokit"]},
+		"release_defs": {"1.3": {"core-kit": ["1.3-prime"], "xorg-kit": ["1.20-release"]}},
+		"kit_settings": {
+			"core-kit": {"default": "1.2-prime", "stability": {"1.3-prime": "prime", "1.2-prime": "deprecated", "next": "beta"}},
+			"xorg-kit": {"default": "1.20-release", "stability": {"1.20-release": "prime"}},
+			"nokit": {"default": "master", "type": "INDY", "stability": {"master": "prime"}},
+		},
+	}
+	kit_sha1 = {
+		"core-kit": {"1.3-prime": {"sha1": "a" * 40, "depth": 5}, "next": "b" * 40},
+		"nokit": {"master": "c" * 40},
+	}
+
+	def table(self, kit_settings=None, release="1.3", **kwargs):
+		return ResolvedKitTable(kit_settings or {}, self.kit_info, self.kit_sha1, release, **kwargs)
+
+	def test_release_defaults(self):
+		table = self.table()
+		self.assertEqual([kit.name for kit in table], ["core-kit", "xorg-kit", "nokit"])
+		core = table["core-kit"]
+		self.assertEqual((core.branch, core.default_branch, core.stability, core.type), ("1.3-prime", "1.3-prime", "prime", "AUTO"))
+		self.assertEqual((core.sha1, core.depth), ("a" * 40, 5))
+		# not in release_defs, so the kit's own default is used:
+		nokit = table["nokit"]
+		self.assertEqual((nokit.branch, nokit.default_branch, nokit.type), ("master", "master", "INDY"))
+		self.assertEqual((nokit.sha1, nokit.depth), ("c" * 40, 2))
+		self.assertEqual([kit.name for kit in self.table(release="1.4")], ["core-kit", "nokit"])
+		self.assertEqual(self.table(release="1.4")["core-kit"].branch, "1.2-prime")
+		self.assertEqual(list(table.kit_names_in_release()), ["core-kit", "xorg-kit"])
+
+	def test_configured_branches(self):
+		table = self.table({"core-kit": "next", "xorg-kit": "skip"}, kits_depth="0")
+		core = table["core-kit"]
+		self.assertEqual((core.branch, core.default_branch, core.stability), ("next", "1.3-prime", "beta"))
+		self.assertEqual((core.sha1, core.depth), ("b" * 40, 1))
+		self.assertFalse(core.deprecated)
+		self.assertEqual(table["xorg-kit"].branch, "skip")
+		self.assertTrue(table["xorg-kit"].missing)
+		self.assertEqual(self.table({"core-kit": "1.2-prime"})["core-kit"].stability, "deprecated")
+		self.assertTrue(self.table({"core-kit": "1.2-prime"})["core-kit"].deprecated)
+		self.assertIsNone(self.table({"core-kit": "1.2-prime"})["core-kit"].sha1)
+
+	def test_version_10_release_defs(self):
+		kit_info = dict(self.kit_info, release_defs={"core-kit": ["next"], "xorg-kit": ["1.20-release"]})
+		table = ResolvedKitTable({"xorg-kit": "skip"}, kit_info, self.kit_sha1, "1.4", metadata_version=10)
+		self.assertEqual(table["core-kit"].branch, "next")
+		self.assertEqual(table.kit_names_in_release(), ["core-kit"])
+
+	def test_unknown_kit(self):
+		table = self.table({"my-overlay": "master"})
+		self.assertEqual((table["my-overlay"].branch, table["my-overlay"].default_branch), ("master", None))
+		self.assertEqual((table["gentoo"].branch, table["gentoo"].type), (None, "AUTO"))
+		self.assertNotIn("gentoo", [kit.name for kit in table])
+		with self.assertRaises(KeyError):
+			table.desired_sha1("gentoo", "master")
+
+	def test_unknown_release(self):
+		with self.assertRaisesRegex(ValueError, "release 1.5"):
+			self.table(release="1.5")
+
+	def test_malformed_kits_depth(self):
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		settings = configparser.ConfigParser()
+		settings.read_dict({"global": {"kits_depth": "full"}})
+		with mock.patch.object(sys, "stderr"), self.assertRaises(SystemExit):
+			EgoConfig(settings, os.path.join(tmp.name, "ego.conf"), root_path=tmp.name, install_path=tmp.name)
+
+	def test_config_shares_table(self):
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		settings = configparser.ConfigParser()
+		settings.read_dict({"global": {"release": "1.3"}})
+		config = EgoConfig(settings, os.path.join(tmp.name, "ego.conf"), root_path=tmp.name, install_path=tmp.name)
+		os.makedirs(os.path.join(config.meta_repo_root, "metadata"))
+		for fn, data in [("kit-info", self.kit_info), ("kit-sha1", self.kit_sha1)]:
+			with open(os.path.join(config.meta_repo_root, "metadata", fn + ".json"), "w") as f:
+				json.dump(data, f)
+		table = config.kit_table
+		self.assertIs(config.kit_table, table)
+		self.assertEqual(config.get_configured_kit("core-kit"), ("1.3-prime", "1.3-prime"))
+		self.assertTrue(config.kit_branch_is_missing("core-kit", "1.1-prime"))
+		self.assertTrue(config.kit_branch_is_deprecated("core-kit", "1.2-prime"))
+		self.assertEqual(config.kit_branch_stability("core-kit", "1.1-prime"), "deprecated")
+		config.set_setting("kits", "core-kit", "next")
+		self.assertIsNot(config.kit_table, table)
+		self.assertEqual(config.get_configured_kit("core-kit"), ("next", "1.3-prime"))
+
+
+class SetSettingsTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, "ego.conf")
+		with open(self.path, "w") as f:
+			f.write("[global]\nrelease = 1.4\n")
+		os.chmod(self.path, 0o640)
+		settings = configparser.ConfigParser()
+		settings.read(self.path)
+		self.config = EgoConfig(settings, self.path, root_path=self.tmp.name, install_path=self.tmp.name)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def read(self):
+		with open(self.path, "r") as f:
+			return f.read()
+
+	def test_dry_run(self):
+		old, new = self.config.set_settings([("kits", "core-kit", "next")], dry_run=True)
+		self.assertEqual(old, "[global]\nrelease = 1.4\n")
+		self.assertIn("[kits]\ncore-kit = next\n", new)
+		self.assertEqual(self.read(), old)
+		self.assertNotIn("kits", self.config.settings)
+
+	def test_written_once(self):
+		changes = [("kits", "core-kit", "next"), ("kits", "xorg-kit", "1.20-release"), ("global", "release", "1.3")]
+		with mock.patch("ego.config.atomic_write", wraps=atomic_write) as write:
+			old, new = self.config.set_settings(changes)
+		self.assertEqual(write.call_count, 1)
+		self.assertEqual(self.read(), new)
+		self.assertEqual(self.config.get_setting("kits", "xorg-kit"), "1.20-release")
+		self.assertEqual(self.config.release, "1.3")
+		self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+
+if __name__ == "__main__":
+	unittest.main()
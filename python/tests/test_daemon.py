@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import configparser
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.client import run_in_daemon
+from ego.config import EgoConfig
+from ego.daemon import EgoServer
+
+EGO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../ego")
+INSTALL_PATH = os.path.dirname(os.path.realpath(EGO))
+
+
+class EgoDaemonTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.socket_path = os.path.join(self.tmp.name, "run", "ego.sock")
+		self.config_path = self.write_config("ego.conf")
+		self.env = dict(os.environ, EGO_CONFIG=self.config_path)
+		self.env.pop("ROOT", None)
+		self.log_path = os.path.join(self.tmp.name, "daemon.log")
+		self.start_daemon()
+
+	def tearDown(self):
+		if self.daemon.poll() is None:
+			self.daemon.terminate()
+			self.daemon.wait(10)
+		self.tmp.cleanup()
+
+	def start_daemon(self):
+		with open(self.log_path, "w") as log:
+			self.daemon = subprocess.Popen([sys.executable, EGO, "daemon", "-v"], env=self.env, stdout=log, stderr=log)
+		for i in range(100):
+			with open(self.log_path, "r") as f:
+				if "listening" in f.read():
+					return
+			time.sleep(0.1)
+		self.fail("ego daemon did not start")
+
+	def write_config(self, name, **settings):
+		settings.setdefault("meta_repo_path", os.path.join(self.tmp.name, "meta-repo"))
+		settings.setdefault("cache_dir", os.path.join(self.tmp.name, "cache"))
+		settings.setdefault("daemon_socket", self.socket_path)
+		path = os.path.join(self.tmp.name, name)
+		with open(path, "w") as f:
+			f.write("[global]\n")
+			for key, value in settings.items():
+				f.write("%s = %s\n" % (key, value))
+		return path
+
+	def daemon_config(self):
+		settings = configparser.ConfigParser()
+		settings.read(self.config_path)
+		return EgoConfig(settings, self.config_path, install_path=INSTALL_PATH)
+
+	def ego(self, *args, env=None):
+		return subprocess.run(
+			[sys.executable, EGO] + list(args), env=env or self.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+		)
+
+	def daemon_ran(self):
+		with open(self.log_path, "r") as f:
+			return [line.strip() for line in f if line.startswith("Running ")]
+
+	def test_command_runs_in_daemon(self):
+		result = self.ego("config", "get", "global", "cache_dir")
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(result.stdout.splitlines()[-1], os.path.join(self.tmp.name, "cache"))
+		self.assertEqual(len(self.daemon_ran()), 1)
+		self.assertIn("config get global cache_dir", self.daemon_ran()[0])
+
+	def test_changed_config_is_reloaded(self):
+		result = self.ego("config", "set", "global", "release", "1.4")
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(self.ego("config", "get", "global", "release").stdout.splitlines()[-1], "1.4")
+		self.assertEqual(len(self.daemon_ran()), 2)
+
+	def test_exit_status(self):
+		result = self.ego("config", "set", "nosuchsection", "key", "value")
+		self.assertEqual(result.returncode, 1)
+		self.assertIn("Section should be one of", result.stderr)
+		self.assertEqual(len(self.daemon_ran()), 1)
+
+	def test_other_config_runs_locally(self):
+		env = dict(self.env, EGO_CONFIG=self.write_config("other.conf", cache_dir="/other/cache"))
+		result = self.ego("config", "get", "global", "cache_dir", env=env)
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(result.stdout.splitlines()[-1], "/other/cache")
+		self.assertEqual(self.daemon_ran(), [])
+
+	def test_other_installation_runs_locally(self):
+		argv = ["ego", "config", "get", "global", "cache_dir"]
+		self.assertIsNone(run_in_daemon(self.socket_path, argv, "/", self.config_path, "/usr/share/ego", "0.0"))
+		self.assertEqual(self.daemon_ran(), [])
+
+	def test_changed_module_is_watched(self):
+		server = EgoServer(self.daemon_config(), self.socket_path)
+		watched = server.watched_files()
+		self.assertIn(os.path.join(INSTALL_PATH, "modules/config.ego"), watched)
+		self.assertIn(os.path.join(INSTALL_PATH, "modules-info/config.json"), watched)
+		self.assertIn(os.path.join(INSTALL_PATH, "python/ego/config.py"), server.code_files())
+
+	def test_environment_is_read_again(self):
+		config = self.daemon_config()
+		old = os.environ.get("EGO_SYNC_BASE_URL")
+		os.environ["EGO_SYNC_BASE_URL"] = "https://example.com/{repo}"
+		try:
+			config.read_environment()
+			self.assertEqual(config.sync_base_url, "https://example.com/{repo}")
+			del os.environ["EGO_SYNC_BASE_URL"]
+			config.read_environment()
+			self.assertEqual(config.sync_base_url, "https://github.com/funtoo/{repo}")
+		finally:
+			if old is not None:
+				os.environ["EGO_SYNC_BASE_URL"] = old
+
+	def test_client_without_daemon(self):
+		self.daemon.terminate()
+		self.daemon.wait(10)
+		self.assertFalse(os.path.exists(self.socket_path))
+		self.assertIsNone(run_in_daemon(self.socket_path, ["ego", "help"], "/", self.config_path, INSTALL_PATH, None))
+		result = self.ego("config", "get", "global", "cache_dir")
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(result.stdout.splitlines()[-1], os.path.join(self.tmp.name, "cache"))
+
+	def test_stale_socket(self):
+		self.daemon.kill()
+		self.daemon.wait(10)
+		# the socket of a daemon that was killed is replaced by a new daemon:
+		self.assertTrue(os.path.exists(self.socket_path))
+		self.start_daemon()
+		self.assertEqual(self.ego("config", "get", "global", "cache_dir").returncode, 0)
+		self.assertEqual(len(self.daemon_ran()), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from git_helper import GitHelper
+
+
+def git(root, *args):
+	env = dict(os.environ, GIT_AUTHOR_NAME="ego", GIT_AUTHOR_EMAIL="ego@localhost", GIT_COMMITTER_NAME="ego",
+		GIT_COMMITTER_EMAIL="ego@localhost")
+	return subprocess.run(["git", "-C", root] + list(args), check=True, env=env, stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+
+
+def make_repo(root, commits=2, branch="master"):
+	os.makedirs(root, exist_ok=True)
+	git(root, "init", "-q", "-b", branch)
+	for i in range(commits):
+		with open(os.path.join(root, "file"), "w") as f:
+			f.write("commit %s\n" % i)
+		git(root, "add", "file")
+		git(root, "commit", "-q", "-m", "commit %s" % i)
+	return git(root, "rev-parse", "HEAD")
+
+
+class GitHelperAlignedTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmp.name, "core-kit")
+		self.sha1 = make_repo(self.root, branch="1.3-prime")
+		self.repo = GitHelper(None, self.root, quiet=True)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_not_aligned_without_stamp(self):
+		self.assertFalse(self.repo.is_aligned("1.3-prime", self.sha1))
+
+	def test_aligned_with_stamp(self):
+		self.repo.write_sync_stamp(self.sha1)
+		self.assertTrue(self.repo.is_aligned("1.3-prime", self.sha1))
+		self.assertFalse(self.repo.is_aligned("1.4-prime", self.sha1))
+		self.assertFalse(self.repo.is_aligned("1.3-prime", "0" * 40))
+
+	def test_aligned_with_packed_refs(self):
+		git(self.root, "pack-refs", "--all")
+		self.assertFalse(os.path.exists(os.path.join(self.root, ".git/refs/heads/1.3-prime")))
+		self.repo.write_sync_stamp(self.sha1)
+		self.assertTrue(self.repo.is_aligned("1.3-prime", self.sha1))
+
+	def test_aligned_detached(self):
+		git(self.root, "checkout", "-q", self.sha1)
+		self.repo.write_sync_stamp(self.sha1)
+		self.assertTrue(self.repo.is_aligned("1.3-prime", self.sha1))
+
+	def test_index_change_invalidates(self):
+		self.repo.write_sync_stamp(self.sha1)
+		with open(os.path.join(self.root, "file"), "w") as f:
+			f.write("local change\n")
+		git(self.root, "add", "file")
+		self.assertFalse(self.repo.is_aligned("1.3-prime", self.sha1))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from git_reader import GitReader
+from test_git_helper import git, make_repo
+
+
+class GitReaderTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmp.name, "repo")
+		self.sha1 = make_repo(self.root, commits=3)
+		git(self.root, "branch", "feature/one", "HEAD~1")
+		git(self.root, "tag", "v1")
+		self.reader = GitReader(self.root)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def assertRefsMatchGit(self):
+		self.assertEqual(self.reader.head(), git(self.root, "rev-parse", "HEAD"))
+		self.assertEqual(self.reader.symbolic_head(), "refs/heads/master")
+		self.assertEqual(self.reader.refs("refs/heads/"), ["refs/heads/feature/one", "refs/heads/master"])
+		self.assertEqual(self.reader.resolve("refs/heads/feature/one")[0], git(self.root, "rev-parse", "feature/one"))
+		self.assertTrue(self.reader.ref_exists("refs/tags/v1"))
+		self.assertFalse(self.reader.ref_exists("refs/heads/missing"))
+
+	def test_loose_refs(self):
+		self.assertTrue(self.reader.is_repo())
+		self.assertRefsMatchGit()
+
+	def test_packed_refs(self):
+		git(self.root, "pack-refs", "--all")
+		self.assertFalse(os.path.exists(os.path.join(self.root, ".git/refs/heads/master")))
+		self.assertRefsMatchGit()
+
+	def test_detached_head(self):
+		git(self.root, "checkout", "-q", "HEAD~2")
+		self.assertIsNone(self.reader.symbolic_head())
+		self.assertEqual(self.reader.head(), git(self.root, "rev-parse", "HEAD"))
+
+	def test_objects(self):
+		commits = git(self.root, "rev-list", "--all").split()
+		for sha1 in commits:
+			self.assertTrue(self.reader.has_object(sha1))
+		self.assertFalse(self.reader.has_object("0" * 40))
+		self.assertFalse(self.reader.has_object("not-a-sha1"))
+		git(self.root, "gc", "-q", "--prune=now")
+		self.assertTrue(os.listdir(os.path.join(self.root, ".git/objects/pack")))
+		for sha1 in commits:
+			self.assertTrue(self.reader.has_object(sha1))
+		self.assertFalse(self.reader.has_object("f" * 40))
+
+	def test_alternates(self):
+		clone = os.path.join(self.tmp.name, "clone")
+		git(self.tmp.name, "clone", "-q", "--shared", self.root, clone)
+		reader = GitReader(clone)
+		self.assertEqual(len(reader.object_dirs()), 2)
+		self.assertTrue(reader.has_object(self.sha1))
+
+	def test_not_a_repo(self):
+		reader = GitReader(os.path.join(self.tmp.name, "nothing"))
+		self.assertFalse(reader.is_repo())
+		self.assertIsNone(reader.head())
+		self.assertEqual(reader.refs(), [])
+
+
+if __name__ == "__main__":
+	unittest.main()
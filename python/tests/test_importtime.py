@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.importtime import ImportProfiler
+
+EGO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../ego")
+
+# Modules that are slow to import, and must only be imported by the ego commands that use them:
+HEAVY_MODULES = ["mediawiki", "mwparserfromhell", "third_party.tabulate_color", "requests", "appi", "portage"]
+
+# Time budget for the imports done by a bare 'ego help', including the interpreter's own startup imports. It is
+# generous, to catch regressions rather than measure; it can be raised through the environment for slow machines, or
+# set to 0 to skip the check.
+IMPORT_BUDGET_MS = float(os.environ.get("EGO_IMPORT_BUDGET_MS", 300))
+
+
+def importtime(args, env):
+	"""
+	Runs ego with ``python -X importtime``. Returns its exit status, ``{module: (self, cumulative)}`` and the total time
+	of all imports, in milliseconds.
+	"""
+	result = subprocess.run(
+		[sys.executable, "-X", "importtime", EGO] + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+	)
+	imports = {}
+	top_level = 0.0
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "[us]" in line:
+			continue
+		self_us, cumulative_us, name = line[len("import time:") :].split("|")
+		imports[name.strip()] = (int(self_us) / 1000, int(cumulative_us) / 1000)
+		if not name.startswith("  "):
+			top_level += int(cumulative_us) / 1000
+	return result.returncode, imports, top_level
+
+
+class StartupImportsTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		config_path = os.path.join(self.tmp.name, "ego.conf")
+		with open(config_path, "w") as f:
+			f.write("[global]\n")
+			f.write("meta_repo_path = %s\n" % os.path.join(self.tmp.name, "meta-repo"))
+			f.write("cache_dir = %s\n" % os.path.join(self.tmp.name, "cache"))
+		self.env = dict(os.environ, EGO_CONFIG=config_path)
+		self.env.pop("ROOT", None)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_ego_help(self):
+		returncode, imports, total = importtime(["help"], self.env)
+		self.assertEqual(returncode, 0)
+		self.assertIn("ego.config", imports)
+		for heavy in HEAVY_MODULES:
+			self.assertNotIn(heavy, imports)
+		if not IMPORT_BUDGET_MS:
+			return
+		# use the best of a few runs, so that a busy machine doesn't cause a failure:
+		for i in range(4):
+			if total <= IMPORT_BUDGET_MS:
+				break
+			total = min(total, importtime(["help"], self.env)[2])
+		self.assertLessEqual(total, IMPORT_BUDGET_MS, "'ego help' imports took %.1fms" % total)
+
+	def test_profile_startup(self):
+		result = subprocess.run(
+			[sys.executable, EGO, "--profile-startup"], env=self.env, stdout=subprocess.PIPE, universal_newlines=True
+		)
+		self.assertEqual(result.returncode, 0)
+		self.assertIn("ego.config", result.stdout)
+		self.assertIn("modules imported in", result.stdout)
+		# only the report is shown:
+		self.assertNotIn("Available ego modules", result.stdout)
+
+
+class ImportProfilerTest(unittest.TestCase):
+	modules = {
+		"profiled_outer": "import profiled_a\nimport profiled_b\n",
+		"profiled_a": "import profiled_leaf\n",
+		"profiled_b": "",
+		"profiled_leaf": "",
+	}
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		for name, source in self.modules.items():
+			with open(os.path.join(self.tmp.name, name + ".py"), "w") as f:
+				f.write(source)
+		sys.path.insert(0, self.tmp.name)
+
+	def tearDown(self):
+		sys.path.remove(self.tmp.name)
+		for name in self.modules:
+			sys.modules.pop(name, None)
+		self.tmp.cleanup()
+
+	def test_records(self):
+		profiler = ImportProfiler()
+		profiler.install()
+		try:
+			with profiler.section("ego_module_test"):
+				import profiled_outer
+		finally:
+			profiler.uninstall()
+		self.assertNotIn(profiler, sys.meta_path)
+		records = profiler.records
+		# recorded in the order the imports started:
+		self.assertEqual(list(records), ["ego_module_test", "profiled_outer", "profiled_a", "profiled_leaf", "profiled_b"])
+		for name in self.modules:
+			self.assertEqual(records[name]["imported_by"], "ego_module_test")
+			self.assertEqual(records[name]["owner"], "ego_module_test")
+			self.assertGreaterEqual(records[name]["self"], 0)
+		self.assertEqual(records["ego_module_test"]["imported_by"], "ego")
+		self.assertEqual(records["ego_module_test"]["owner"], "ego_module_test")
+
+		# the time of nested imports is part of the cumulative, but not the self, time of the module importing them:
+		def nested(name, *children):
+			return records[name]["self"] + sum(records[child]["cumulative"] for child in children)
+
+		self.assertAlmostEqual(records["profiled_a"]["cumulative"], nested("profiled_a", "profiled_leaf"))
+		self.assertAlmostEqual(records["profiled_outer"]["cumulative"], nested("profiled_outer", "profiled_a", "profiled_b"))
+		self.assertAlmostEqual(records["ego_module_test"]["cumulative"], nested("ego_module_test", "profiled_outer"))
+		self.assertEqual(records["profiled_leaf"]["self"], records["profiled_leaf"]["cumulative"])
+
+		self.assertEqual([(owner, count) for owner, count, duration in profiler.by_owner()], [("ego_module_test", 5)])
+		self.assertAlmostEqual(profiler.total(), records["ego_module_test"]["cumulative"])
+		out = StringIO()
+		profiler.report(out)
+		for name in self.modules:
+			self.assertIn(name, out.getvalue())
+		self.assertIn("5 modules imported", out.getvalue())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+import fcntl
+import io
+import json
+import os
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.module import EgoModule, EgoModuleLoader
+
+
+class EgoModuleLoaderTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.ego_dir = os.path.join(self.tmp.name, "ego")
+		os.makedirs(os.path.join(self.ego_dir, "modules"))
+		self.cache_dir = os.path.join(self.tmp.name, "cache")
+		self.user_cache = os.path.join(self.tmp.name, "user-cache")
+		self.config = SimpleNamespace(ego_dir=self.ego_dir, cache_dir=self.cache_dir)
+		self.write_module("hello", "VALUE = 1\n")
+		patches = [
+			mock.patch.object(sys, "dont_write_bytecode", False),
+			mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.user_cache}),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def tearDown(self):
+		os.chmod(self.tmp.name, 0o755)
+		if os.path.exists(self.cache_dir):
+			os.chmod(self.cache_dir, 0o755)
+		self.tmp.cleanup()
+
+	def write_module(self, name, source):
+		with open(os.path.join(self.ego_dir, "modules", name + ".ego"), "w") as f:
+			f.write(source)
+
+	def cached_files(self, cache_dir):
+		try:
+			return [fn for fn in os.listdir(cache_dir) if fn.endswith(".pyc")]
+		except FileNotFoundError:
+			return []
+
+	def test_bytecode_is_cached(self):
+		mod = EgoModule.load_ego_module("hello", self.config)
+		self.assertEqual(mod.VALUE, 1)
+		self.assertEqual(mod.__name__, "ego_module_hello")
+		self.assertEqual(len(self.cached_files(os.path.join(self.cache_dir, "modules"))), 1)
+		with mock.patch.object(EgoModuleLoader, "source_to_code") as source_to_code:
+			mod = EgoModule.load_ego_module("hello", self.config)
+			source_to_code.assert_not_called()
+		self.assertEqual(mod.VALUE, 1)
+
+	def test_changed_source_is_recompiled(self):
+		EgoModule.load_ego_module("hello", self.config)
+		self.write_module("hello", "VALUE = 22\n")
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 22)
+		self.assertEqual(len(self.cached_files(os.path.join(self.cache_dir, "modules"))), 1)
+
+	def test_read_only_cache_dir(self):
+		if os.geteuid() == 0:
+			self.skipTest("permissions are not enforced for root")
+		os.makedirs(self.cache_dir)
+		os.chmod(self.cache_dir, stat.S_IRUSR | stat.S_IXUSR)
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 1)
+		self.assertEqual(len(self.cached_files(os.path.join(self.user_cache, "ego", "modules"))), 1)
+
+	def test_unwritable_cache_falls_back(self):
+		# a cache directory that can't be created, such as a path below a regular file:
+		blocker = os.path.join(self.tmp.name, "not-a-dir")
+		open(blocker, "w").close()
+		self.config.cache_dir = blocker
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 1)
+		self.assertEqual(len(self.cached_files(os.path.join(self.user_cache, "ego", "modules"))), 1)
+
+	def test_untrusted_cache_is_not_used(self):
+		blocker = os.path.join(self.tmp.name, "not-a-dir")
+		open(blocker, "w").close()
+		self.config.cache_dir = blocker
+		EgoModule.load_ego_module("hello", self.config)
+		user_modules = os.path.join(self.user_cache, "ego", "modules")
+		self.assertEqual(len(self.cached_files(user_modules)), 1)
+
+		# a cache directory that others can write to, whose bytecode could have been replaced by anyone:
+		os.chmod(user_modules, 0o777)
+		cache_file = os.path.join(user_modules, self.cached_files(user_modules)[0])
+		with open(cache_file, "rb") as f:
+			cached = f.read()
+		del sys.modules["ego_module_hello"]
+		with mock.patch.object(EgoModuleLoader, "source_to_code", autospec=True, side_effect=EgoModuleLoader.source_to_code) as source_to_code:
+			self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 1)
+			source_to_code.assert_called_once()
+		# and nothing is written to it:
+		self.write_module("hello", "VALUE = 2\n")
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 2)
+		with open(cache_file, "rb") as f:
+			self.assertEqual(f.read(), cached)
+
+	def test_dont_write_bytecode(self):
+		sys.dont_write_bytecode = True
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 1)
+		self.assertEqual(self.cached_files(os.path.join(self.cache_dir, "modules")), [])
+
+	def test_corrupt_cache_is_ignored(self):
+		EgoModule.load_ego_module("hello", self.config)
+		modules_cache = os.path.join(self.cache_dir, "modules")
+		path = os.path.join(modules_cache, self.cached_files(modules_cache)[0])
+		with open(path, "r+b") as f:
+			f.seek(EgoModuleLoader.header.size)
+			f.write(b"\xff\xff\xff")
+			f.truncate()
+		self.assertEqual(EgoModule.load_ego_module("hello", self.config).VALUE, 1)
+
+	def test_missing_module(self):
+		with self.assertRaises(FileNotFoundError):
+			EgoModule.load_ego_module("missing", self.config)
+		self.assertNotIn("ego_module_missing", sys.modules)
+		self.assertIsNone(EgoModule.run_ego_module("missing", self.config, []))
+
+
+class MutationLockTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.ego_dir = self.tmp.name
+		os.makedirs(os.path.join(self.ego_dir, "modules"))
+		with open(os.path.join(self.ego_dir, "modules", "lockme.ego"), "w") as f:
+			f.write("from ego.module import EgoModule\n\n")
+			f.write("class Module(EgoModule):\n")
+			f.write("\tran = []\n")
+			f.write("\tdef add_arguments(self, parser):\n\t\tparser.add_argument('action')\n")
+			f.write("\tdef read_only(self):\n\t\treturn self.options.action == 'get'\n")
+			f.write("\tdef handle(self):\n\t\tself.ran.append(self.options.action)\n")
+		info = {"description": "", "version": "1.0", "author": ""}
+		self.config = SimpleNamespace(ego_dir=self.ego_dir, cache_dir=None, ego_mods_info={"lockme": info})
+		self.lock_path = os.path.join(self.tmp.name, "ego.lock")
+		open(self.lock_path, "w").close()
+		EgoModule.lock_fd = os.open(self.lock_path, os.O_RDONLY)
+
+	def tearDown(self):
+		os.close(EgoModule.lock_fd)
+		EgoModule.lock_fd = None
+		self.tmp.cleanup()
+
+	def run_in_thread(self, args):
+		thread = threading.Thread(target=EgoModule.run_ego_module, args=("lockme", self.config, args))
+		thread.start()
+		thread.join(0.5)
+		return thread
+
+	def test_only_changes_wait_for_lock(self):
+		with open(self.lock_path, "r") as holder:
+			fcntl.flock(holder, fcntl.LOCK_EX)
+			self.assertFalse(self.run_in_thread(["get"]).is_alive())
+			# global options such as --json or -q come before the action:
+			thread = self.run_in_thread(["-q", "set"])
+			self.assertTrue(thread.is_alive())
+			ran = sys.modules["ego_module_lockme"].Module.ran
+			self.assertEqual(ran, ["get"])
+		thread.join(5)
+		self.assertEqual(ran, ["get", "set"])
+
+	def test_read_only_actions(self):
+		modules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../modules")
+		config = SimpleNamespace(ego_dir=os.path.join(modules_dir, ".."), cache_dir=None, ego_mods_info={
+			name: {"description": "", "version": "1.0", "author": ""} for name in ["config", "profile"]
+		})
+		for name, args, read_only in [
+			("config", ["get", "global", "sync_jobs"], True),
+			("config", ["set", "--dry-run", "global", "sync_jobs", "2"], True),
+			("config", ["--json", "set", "global", "sync_jobs", "2"], False),
+			("config", ["-q", "set", "global", "sync_jobs", "2"], False),
+			# showing profiles may fix up the parent file:
+			("profile", ["show"], False),
+		]:
+			module = EgoModule.load_ego_module(name, config).Module(name, config)
+			with mock.patch.object(module, "handle"):
+				module(*args)
+			self.assertEqual(module.read_only(), read_only, args)
+
+
+class JsonOutputTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		os.makedirs(os.path.join(self.tmp.name, "modules"))
+		for name, supports_json in [("records", True), ("textonly", False)]:
+			with open(os.path.join(self.tmp.name, "modules", name + ".ego"), "w") as f:
+				f.write("from ego.module import EgoModule\n")
+				f.write("from ego.output import Output\n\n")
+				f.write("class Module(EgoModule):\n")
+				f.write("\tsupports_json = %s\n" % supports_json)
+				f.write("\tdef add_arguments(self, parser):\n\t\tparser.add_argument('action')\n")
+				f.write("\tdef handle(self):\n")
+				f.write("\t\tprint('text')\n\t\tOutput.log('log')\n")
+				f.write("\t\tif self.json:\n\t\t\tOutput.record({'action': self.options.action})\n")
+		info = {"description": "", "version": "1.0", "author": ""}
+		self.config = SimpleNamespace(
+			ego_dir=self.tmp.name, cache_dir=None, ego_mods_info={"records": info, "textonly": info}
+		)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def run_module(self, name, *args):
+		stdout, stderr = io.StringIO(), io.StringIO()
+		with mock.patch.object(sys, "stdout", stdout), mock.patch.object(sys, "stderr", stderr):
+			try:
+				EgoModule.run_ego_module(name, self.config, list(args))
+			except SystemExit as e:
+				self.assertEqual(e.code, 2)
+		return stdout.getvalue(), stderr.getvalue()
+
+	def test_records_on_stdout(self):
+		stdout, stderr = self.run_module("records", "list", "--json")
+		self.assertEqual(json.loads(stdout), {"action": "list"})
+		self.assertEqual(stderr, "text\nlog\n")
+		self.assertEqual(self.run_module("records", "list"), ("text\nlog\n", ""))
+
+	def test_not_supported(self):
+		stdout, stderr = self.run_module("textonly", "--json", "list")
+		self.assertEqual(stdout, "")
+		self.assertIn("--json is not supported by ego textonly", stderr)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+import configparser
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.config import EgoConfig, metadata_cache
+from ego.module import EgoModule
+from ego.profile import (
+	ProfileCatalogIndex,
+	ProfileTree,
+	ProfileType,
+	all_funtoo_repos,
+	getProfileCatalogAndTree,
+	parent_cache,
+)
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_LINES = [
+	"core-kit:funtoo/1.0/linux-gnu/arch/x86-64bit",
+	"core-kit:funtoo/1.0/linux-gnu/build/current",
+	"core-kit:funtoo/1.0/linux-gnu/flavor/desktop",
+	"core-kit:funtoo/1.0/linux-gnu/mix-ins/audio",
+]
+
+
+class ProfileTreeTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = self.tmp.name
+		kits = os.path.join(self.root, "var/git/meta-repo/kits/core-kit")
+		os.makedirs(kits)
+		os.symlink(os.path.join(TESTS_DIR, "profiles"), os.path.join(kits, "profiles"))
+		os.makedirs(os.path.join(self.root, "etc/portage/repos.conf"))
+		with open(os.path.join(self.root, "etc/portage/repos.conf/ego-core-kit"), "w") as f:
+			f.write("[core-kit]\nlocation = /var/git/meta-repo/kits/core-kit\n")
+		os.makedirs(os.path.join(self.root, "etc/portage/make.profile"))
+		with open(os.path.join(self.root, "etc/portage/make.profile/parent"), "w") as f:
+			f.write("\n".join(PARENT_LINES) + "\n")
+		settings = configparser.ConfigParser()
+		self.config = EgoConfig(settings, os.path.join(self.root, "ego.conf"), root_path=self.root, install_path=self.root)
+		self.catalog, self.tree = getProfileCatalogAndTree(self.config)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def names(self, profile_type, recursive=False):
+		if recursive:
+			return sorted(set(spec.name for spec in self.tree.recursively_get_children(profile_type)))
+		return [spec.name for spec in self.tree.get_children(profile_type)]
+
+	def path(self, profile_type, name):
+		# as in ego profile, find_path() only knows about profiles that have been listed:
+		list(self.catalog.list(profile_type))
+		return self.catalog.find_path(profile_type, name)
+
+	def fresh_tree(self):
+		# a tree of the same lines, read from scratch:
+		lines = [spec.spec_str for spec in self.tree.profile_hier.keys()]
+		tree = ProfileTree(self.catalog, "core-kit", self.config, self.catalog.funtoo_repos)
+		tree.reload(lines)
+		return tree
+
+	def test_edits_reuse_resolved_profiles(self):
+		audio = next(self.tree.get_children(ProfileType.MIX_IN))
+		with mock.patch.object(ProfileTree, "_read_parent", autospec=True, side_effect=ProfileTree._read_parent) as read:
+			self.tree.append_mixin(self.path(ProfileType.MIX_IN, "print"))
+			# print is inherited from the desktop flavor already:
+			self.assertEqual(read.call_count, 0)
+			self.tree.append_mixin(self.path(ProfileType.MIX_IN, "gnome"))
+			gnome_reads = read.call_count
+			self.assertGreater(gnome_reads, 0)
+			self.tree.remove_name(ProfileType.MIX_IN, "audio")
+			self.tree.remove_line(self.path(ProfileType.MIX_IN, "print"))
+			self.tree.insert_or_replace_entry(ProfileType.FLAVOR, self.path(ProfileType.FLAVOR, "workstation"))
+			self.tree.append_mixin(self.path(ProfileType.MIX_IN, "audio"))
+			self.assertEqual(read.call_count, gnome_reads)
+		self.assertEqual(self.names(ProfileType.MIX_IN), ["gnome", "audio"])
+		self.assertEqual(self.names(ProfileType.FLAVOR), ["workstation"])
+		# lines that didn't change keep their specifier:
+		self.assertIs(next(self.tree.get_children(ProfileType.ARCH)), list(self.tree.profile_hier.keys())[0])
+		self.assertIsNot(next(self.tree.get_children(ProfileType.MIX_IN)), audio)
+
+		fresh = self.fresh_tree()
+		for profile_type in [ProfileType.FLAVOR, ProfileType.MIX_IN]:
+			self.assertEqual(
+				self.names(profile_type, recursive=True),
+				sorted(set(spec.name for spec in fresh.recursively_get_children(profile_type))),
+			)
+
+	def walk(self, child_dict):
+		# the depth-first order that recursively_get_children() should follow:
+		for spec, children in child_dict.items():
+			yield spec
+			yield from self.walk(children)
+
+	def test_recursively_get_children(self):
+		self.tree.append_mixin(self.path(ProfileType.MIX_IN, "gnome"))
+		everything = list(self.walk(self.tree.profile_hier))
+		self.assertEqual(self.tree.recursively_get_children(), everything)
+		for child_types in [ProfileType.MIX_IN, [ProfileType.FLAVOR, ProfileType.MIX_IN], [ProfileType.OTHER]]:
+			types = [child_types] if isinstance(child_types, ProfileType) else child_types
+			self.assertEqual(
+				self.tree.recursively_get_children(child_types), [spec for spec in everything if spec.classify() in types]
+			)
+		for specifier in self.tree.get_children():
+			self.assertEqual(
+				self.tree.recursively_get_children(ProfileType.MIX_IN, specifier=specifier),
+				[spec for spec in self.walk(self.tree.profile_hier[specifier]) if spec.classify() == ProfileType.MIX_IN],
+			)
+		self.assertIn("gnome", self.names(ProfileType.MIX_IN, recursive=True))
+
+		# the index is rebuilt when the tree changes:
+		self.tree.remove_name(ProfileType.MIX_IN, "gnome")
+		self.assertEqual(self.tree.recursively_get_children(), list(self.walk(self.tree.profile_hier)))
+
+	def test_parent_files_are_cached(self):
+		hits, misses = parent_cache.hits, parent_cache.misses
+		tree = ProfileTree(self.catalog, "core-kit", self.config, self.catalog.funtoo_repos)
+		self.assertEqual(parent_cache.misses, misses)
+		self.assertGreater(parent_cache.hits, hits)
+		self.assertEqual(self.names(ProfileType.FLAVOR, recursive=True), sorted(set(spec.name for spec in tree.recursively_get_children(ProfileType.FLAVOR))))
+
+		# a changed parent file is read again:
+		with open(os.path.join(self.root, "etc/portage/make.profile/parent"), "a") as f:
+			f.write("core-kit:funtoo/1.0/linux-gnu/mix-ins/gnome\n")
+		misses = parent_cache.misses
+		tree = ProfileTree(self.catalog, "core-kit", self.config, self.catalog.funtoo_repos)
+		self.assertEqual([spec.name for spec in tree.get_children(ProfileType.MIX_IN)], ["audio", "gnome"])
+		self.assertGreater(parent_cache.misses, misses)
+
+		# the next ego command uses the entries stored in the cache directory:
+		self.assertTrue(os.path.exists(os.path.join(self.config.cache_dir, "profile-parents.marshal")))
+		parent_cache.clear()
+		parent_cache.path = None
+		misses = parent_cache.misses
+		ProfileTree(self.catalog, "core-kit", self.config, self.catalog.funtoo_repos)
+		self.assertEqual(parent_cache.misses, misses)
+
+		# ...unless others can write to it:
+		os.chmod(os.path.join(self.config.cache_dir, "profile-parents.marshal"), 0o666)
+		parent_cache.clear()
+		parent_cache.path = None
+		misses = parent_cache.misses
+		ProfileTree(self.catalog, "core-kit", self.config, self.catalog.funtoo_repos)
+		self.assertGreater(parent_cache.misses, misses)
+
+	def test_apply(self):
+		arch = next(self.tree.get_children(ProfileType.ARCH))
+		desktop = next(self.tree.get_children(ProfileType.FLAVOR))
+		self.catalog.set_arch("x86-64bit")
+		profiles = {
+			ProfileType.SUBARCH: self.path(ProfileType.SUBARCH, "generic_64"),
+			ProfileType.FLAVOR: self.path(ProfileType.FLAVOR, "desktop"),
+			ProfileType.MIX_IN: [self.path(ProfileType.MIX_IN, "gnome"), self.path(ProfileType.MIX_IN, "audio")],
+		}
+		with mock.patch.object(ProfileTree, "_set_lines", autospec=True, side_effect=ProfileTree._set_lines) as set_lines:
+			self.assertTrue(self.tree.apply(profiles))
+			# applying the same profiles again changes nothing:
+			self.assertFalse(self.tree.apply(profiles))
+		self.assertEqual(set_lines.call_count, 1)
+		self.assertEqual(
+			[spec.spec_str for spec in self.tree.profile_hier.keys()],
+			[
+				PARENT_LINES[0],
+				"core-kit:funtoo/1.0/linux-gnu/arch/x86-64bit/subarch/generic_64",
+				PARENT_LINES[1],
+				PARENT_LINES[2],
+				PARENT_LINES[3],
+				"core-kit:funtoo/1.0/linux-gnu/mix-ins/gnome",
+			],
+		)
+		# profiles that were already enabled keep their specifier:
+		self.assertIs(next(self.tree.get_children(ProfileType.ARCH)), arch)
+		self.assertIs(next(self.tree.get_children(ProfileType.FLAVOR)), desktop)
+
+		self.assertTrue(self.tree.apply({ProfileType.FLAVOR: self.path(ProfileType.FLAVOR, "workstation"), ProfileType.MIX_IN: []}))
+		self.assertEqual(self.names(ProfileType.FLAVOR), ["workstation"])
+		self.assertEqual(self.names(ProfileType.MIX_IN), [])
+		self.assertEqual(self.names(ProfileType.SUBARCH), ["generic_64"])
+
+	def run_profile_module(self, *args):
+		module = EgoModule.load_ego_module("profile", SimpleNamespace(ego_dir=os.path.join(TESTS_DIR, "../.."), cache_dir=None))
+		self.config.ego_mods_info = {"profile": {"description": "", "version": "1.0", "author": ""}}
+		stdout = io.StringIO()
+		with mock.patch.object(sys, "stdout", stdout):
+			module.Module("profile", self.config)(*args)
+		return stdout.getvalue()
+
+	def test_apply_show_json(self):
+		profiles = self.run_profile_module("show-json", "--json")
+		# no subarch is set, which show-json lists as an empty list:
+		self.assertEqual(json.loads(profiles)["subarch"], [])
+		source = os.path.join(self.root, "profiles.json")
+		with open(source, "w") as f:
+			f.write(profiles)
+		with open(os.path.join(self.root, "etc/portage/make.profile/parent"), "r") as f:
+			before = f.read()
+		output = self.run_profile_module("apply", "--from", source)
+		self.assertIn("Profiles already up-to-date", output)
+		with open(os.path.join(self.root, "etc/portage/make.profile/parent"), "r") as f:
+			self.assertEqual(f.read(), before)
+
+	def set_kit_commit(self, sha1):
+		git_dir = os.path.join(self.root, "var/git/meta-repo/kits/core-kit/.git")
+		os.makedirs(git_dir, exist_ok=True)
+		with open(os.path.join(git_dir, "HEAD"), "w") as f:
+			f.write(sha1 + "\n")
+
+	def listed(self, catalog):
+		catalog.set_arch("x86-64bit")
+		return {key: sorted(catalog.list(key)) for key in ProfileType.valid()}, catalog.directory_map
+
+	def test_catalog_index(self):
+		scanned = self.listed(self.catalog.catalogs["core-kit"])
+		self.set_kit_commit("1" * 40)
+		ProfileCatalogIndex(self.config).write(all_funtoo_repos(self.config))
+
+		metadata_stats = (metadata_cache.hits, metadata_cache.misses)
+		catalog, tree = getProfileCatalogAndTree(self.config)
+		self.assertIsNotNone(catalog.catalogs["core-kit"].index)
+		self.assertEqual((metadata_cache.hits, metadata_cache.misses), metadata_stats)
+		with mock.patch("os.scandir", side_effect=AssertionError("profile directories were read")):
+			self.assertEqual(self.listed(catalog.catalogs["core-kit"]), scanned)
+		self.assertIn("gnome", scanned[0][ProfileType.MIX_IN])
+
+		# once the kit is at another commit, the profile directories are read again:
+		self.set_kit_commit("2" * 40)
+		catalog, tree = getProfileCatalogAndTree(self.config)
+		self.assertIsNone(catalog.catalogs["core-kit"].index)
+		with mock.patch("os.scandir", side_effect=os.scandir) as scandir:
+			self.assertEqual(self.listed(catalog.catalogs["core-kit"]), scanned)
+		self.assertGreater(scandir.call_count, 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.registry import ModuleInfoMap, ModuleRegistry
+
+
+class ModuleRegistryTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.ego_dir = self.tmp.name
+		os.makedirs(os.path.join(self.ego_dir, "modules"))
+		os.makedirs(os.path.join(self.ego_dir, "modules-info"))
+		self.add_module("sync", {"description": "Synchronize Portage tree"})
+		self.add_module("profile", {"description": "Manage Funtoo Linux profiles", "shortcut": "/usr/sbin/epro"})
+		self.add_module("upgrade-ideas", None)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def add_module(self, name, info):
+		with open(os.path.join(self.ego_dir, "modules", name + ".ego"), "w") as f:
+			f.write("# %s\n" % name)
+		if info is not None:
+			self.write_info(name, info)
+
+	def write_info(self, name, info):
+		with open(os.path.join(self.ego_dir, "modules-info", name + ".json"), "w") as f:
+			f.write(json.dumps(info))
+
+	def test_single_module_reads_only_its_own_info(self):
+		registry = ModuleRegistry(self.ego_dir)
+		with mock.patch("glob.glob") as glob:
+			self.assertEqual(registry.info("sync")["description"], "Synchronize Portage tree")
+			self.assertEqual(registry.info("upgrade-ideas"), {})
+			self.assertIn("profile", ModuleInfoMap(registry))
+			self.assertNotIn("nonexistent", ModuleInfoMap(registry))
+			glob.assert_not_called()
+		self.assertFalse(os.path.exists(registry.index_path))
+
+	def test_index(self):
+		registry = ModuleRegistry(self.ego_dir)
+		self.assertEqual(registry.names(), ["profile", "sync", "upgrade-ideas"])
+		self.assertTrue(os.path.exists(registry.index_path))
+
+		# a fresh index is used without parsing any module metadata:
+		registry = ModuleRegistry(self.ego_dir)
+		with mock.patch.object(ModuleRegistry, "build_index") as build_index:
+			self.assertEqual(dict(ModuleInfoMap(registry))["profile"]["shortcut"], "/usr/sbin/epro")
+			build_index.assert_not_called()
+
+		# changed metadata, or a new module, make the index stale:
+		self.write_info("sync", {"description": "Sync kits"})
+		registry = ModuleRegistry(self.ego_dir)
+		self.assertEqual(dict(registry.available())["sync"]["description"], "Sync kits")
+		self.add_module("kit", {"description": "Kit-related information"})
+		self.assertEqual(ModuleRegistry(self.ego_dir).names(), ["kit", "profile", "sync", "upgrade-ideas"])
+
+	def test_read_only_install(self):
+		registry = ModuleRegistry(self.ego_dir)
+		with mock.patch.object(ModuleRegistry, "write_index", side_effect=PermissionError):
+			self.assertEqual(len(list(registry.available())), 3)
+
+	def test_shortcut(self):
+		self.assertEqual(ModuleRegistry(self.ego_dir).module_for_shortcut("epro"), "profile")
+		self.assertIsNone(ModuleRegistry(self.ego_dir).module_for_shortcut("boot-update"))
+		# even with a stale index, the module's own metadata has the final say:
+		self.write_info("profile", {"description": "Manage Funtoo Linux profiles"})
+		self.write_info("sync", {"shortcut": "/usr/sbin/epro"})
+		self.assertEqual(ModuleRegistry(self.ego_dir).module_for_shortcut("epro"), "sync")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+
+import fcntl
+import importlib.machinery
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ego.config import ResolvedKitTable
+from git_helper import GitHelper
+from test_git_helper import git, make_repo
+
+modules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../modules")
+
+
+def load_ego_module(name):
+	loader = importlib.machinery.SourceFileLoader("ego_module_%s" % name, os.path.join(modules_dir, name + ".ego"))
+	spec = importlib.util.spec_from_loader(loader.name, loader)
+	module = importlib.util.module_from_spec(spec)
+	loader.exec_module(module)
+	return module
+
+
+class SyncKitTest(unittest.TestCase):
+
+	"""
+	Syncs kits from local bare repositories, using a ``file://`` sync_base_url.
+	"""
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.src = src = os.path.join(self.tmp.name, "src")
+		make_repo(src, commits=4, branch="1.3-prime")
+		self.commits = git(src, "rev-list", "HEAD").split()
+		self.bare = os.path.join(self.tmp.name, "core-kit.git")
+		git(self.tmp.name, "clone", "-q", "--bare", src, self.bare)
+		self.kits_root = os.path.join(self.tmp.name, "kits")
+		os.makedirs(self.kits_root)
+		self.sync = load_ego_module("sync")
+		self.config = SimpleNamespace(
+			ego_mods_info={"sync": {}},
+			kit_sha1_metadata={"core-kit": {"1.3-prime": {"sha1": self.commits[0], "depth": 2}}},
+			kit_info_metadata={"kit_settings": {"core-kit": {"type": "AUTO", "stability": {"1.3-prime": "prime"}}}, "kit_order": ["core-kit"]},
+			release="1.3",
+			meta_repo_branch="master",
+			sync_base_url="file://" + self.tmp.name + "/{repo}.git",
+			kits_depth=2,
+			kits_root=self.kits_root,
+			shared_objects=False,
+			sync_jobs=2,
+			shared_objects_path=os.path.join(self.tmp.name, "shared.git"),
+			meta_repo_root=os.path.join(self.tmp.name, "meta-repo"),
+		)
+		self.config.kit_table = ResolvedKitTable(
+			{"core-kit": "1.3-prime"}, self.config.kit_info_metadata, self.config.kit_sha1_metadata, self.config.release
+		)
+		self.module = self.new_module()
+		self.kit = GitHelper(None, os.path.join(self.kits_root, "core-kit"))
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def new_module(self, config=None):
+		module = self.sync.Module("sync", config or self.config)
+		module.options = SimpleNamespace(in_place=False, full_sync=False, dest=None, kits=True, bundle_in=None, bundle_out=None, jobs=None)
+		return module
+
+	def set_desired(self, sha1):
+		self.config.kit_sha1_metadata["core-kit"]["1.3-prime"]["sha1"] = sha1
+
+	def test_clone_and_fetch_by_sha1(self):
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertEqual(self.kit.commitID, self.commits[0])
+		self.assertTrue(self.kit.isShallow())
+		self.assertTrue(self.module.kit_is_aligned("core-kit", "1.3-prime"))
+
+		# go back to an older commit, which is not part of the shallow clone:
+		self.assertFalse(self.kit.hasCommit(self.commits[3]))
+		self.set_desired(self.commits[3])
+		self.assertFalse(self.module.kit_is_aligned("core-kit", "1.3-prime"))
+		with mock.patch.object(GitHelper, "fetchRemote") as fetch_remote:
+			self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+			fetch_remote.assert_not_called()
+		self.assertEqual(self.kit.commitID, self.commits[3])
+		self.assertEqual(self.kit.reader.symbolic_head(), "refs/heads/1.3-prime")
+		self.assertTrue(self.kit.isShallow())
+		self.assertTrue(self.module.kit_is_aligned("core-kit", "1.3-prime"))
+
+	def test_fallback_when_sha1_fetch_refused(self):
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+
+		# upstream advances by two commits and we want the first of them. Without protocol v2 or
+		# allowReachableSHA1InWant, the server refuses requests for commits that are not at the tip of a branch:
+		make_repo(self.src, commits=2, branch="1.3-prime")
+		git(self.src, "push", "-q", self.bare, "1.3-prime")
+		new_sha1 = git(self.src, "rev-parse", "HEAD~1")
+		self.set_desired(new_sha1)
+		protocol_v0 = {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "protocol.version", "GIT_CONFIG_VALUE_0": "0"}
+		with mock.patch.dict(os.environ, protocol_v0):
+			with mock.patch.object(GitHelper, "fetchRemote", autospec=True, side_effect=GitHelper.fetchRemote) as fr:
+				self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+				self.assertTrue(fr.called)
+		self.assertEqual(self.kit.commitID, new_sha1)
+		self.assertTrue(self.module.kit_is_aligned("core-kit", "1.3-prime"))
+
+	def test_shared_object_store(self):
+		self.config.shared_objects = True
+		self.module.prepare_shared_store()
+		store = self.module.shared_store
+		self.assertTrue(store.exists())
+		with store.lock():
+			self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertFalse(self.kit.isShallow())
+		self.assertEqual(git(store.root, "rev-parse", "refs/kits/core-kit/1.3-prime"), self.commits[0])
+
+		# a second copy of the kit (as if for another release) borrows everything from the shared store:
+		other_root = os.path.join(self.tmp.name, "other-kits")
+		self.assertTrue(self.module.sync_kit("core-kit", other_root, "1.3-prime", "1.3-prime"))
+		other = GitHelper(None, os.path.join(other_root, "core-kit"))
+		self.assertEqual(other.commitID, self.commits[0])
+		with open(os.path.join(other.git_dir, "objects/info/alternates")) as f:
+			self.assertEqual(f.read().strip(), store.objects_dir)
+		self.assertEqual(git(other.root, "count-objects", "-v").split("\n")[0], "count: 0")
+
+		self.assertTrue(self.module.gc_shared_store())
+		self.assertEqual(os.listdir(os.path.join(self.kit.git_dir, "objects/pack")), [])
+		git(self.kit.root, "fsck", "--no-progress")
+		self.assertEqual(git(self.kit.root, "log", "--format=%H"), "\n".join(self.commits))
+
+	def test_shallow_kit_skips_shared_object_store(self):
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertTrue(self.kit.isShallow())
+		self.config.shared_objects = True
+		module = self.new_module()
+		module.prepare_shared_store()
+		self.set_desired(self.commits[1])
+		with module.shared_store.lock(), mock.patch("ego.output.Output.log"):
+			self.assertTrue(module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertEqual(self.kit.commitID, self.commits[1])
+		self.assertTrue(self.kit.isShallow())
+		self.assertFalse(os.path.exists(os.path.join(self.kit.git_dir, "objects/info/alternates")))
+
+	def assert_locked(self, store):
+		with open(os.path.join(store.root, "ego.lock"), "a") as lockfile:
+			with self.assertRaises(BlockingIOError):
+				fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+	def test_shared_store_lock_survives_children(self):
+		self.config.shared_objects = True
+		self.module.prepare_shared_store()
+		store = self.module.shared_store
+		with store.lock():
+			# kits are synced in forked children, which must not release the lock that we hold:
+			with mock.patch.object(self.module, "drop_perms"):
+				self.assertEqual(self.module.drop_perms_and_run(lambda: True), 0)
+				self.assertNotEqual(self.module.drop_perms_and_run(lambda: False), 0)
+			self.assert_locked(store)
+
+			# a child that leaves the locked block itself doesn't release it either:
+			lock = store.lock()
+			lock.__enter__()
+			pid = os.fork()
+			if pid == 0:
+				try:
+					lock.__exit__(None, None, None)
+				finally:
+					os._exit(0)
+			os.waitpid(pid, 0)
+			self.assert_locked(store)
+			lock.__exit__(None, None, None)
+
+	def test_journal(self):
+		meta_sha1 = make_repo(self.config.meta_repo_root)
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.module.journal.start(meta_sha1)
+		self.assertFalse(self.module.kit_is_journaled("core-kit", "1.3-prime"))
+		self.module.kit_sync_complete("core-kit", "1.3-prime", 256)
+		self.assertFalse(self.module.kit_is_journaled("core-kit", "1.3-prime"))
+		self.module.kit_sync_complete("core-kit", "1.3-prime", 0)
+		self.assertTrue(self.module.kit_is_journaled("core-kit", "1.3-prime"))
+
+		# interrupted; the next sync of the same meta-repo SHA1 picks up where we left off:
+		module = self.new_module()
+		self.assertTrue(module.journal.interrupted(meta_sha1))
+		module.journal.start(meta_sha1)
+		self.assertTrue(module.kit_is_journaled("core-kit", "1.3-prime"))
+		module.options.full_sync = True
+		self.assertFalse(module.kit_is_journaled("core-kit", "1.3-prime"))
+		module.options.full_sync = False
+
+		# ...unless meta-repo (and thus the desired kit SHA1s) changed:
+		module.journal.start("0" * 40)
+		self.assertFalse(module.kit_is_journaled("core-kit", "1.3-prime"))
+		module.journal.finish()
+		module = self.new_module()
+		self.assertFalse(module.journal.interrupted("0" * 40))
+		self.assertFalse(module.kit_is_journaled("core-kit", "1.3-prime"))
+
+	def test_timings_file_keeps_last_syncs(self):
+		self.config.root_path = self.tmp.name
+		self.module.options.timings = False
+		self.module.timings_kept = 3
+		for i in range(5):
+			self.module.report_timings(time.monotonic(), i % 2 == 0)
+		with open(self.module.timings_path) as f:
+			records = [json.loads(line) for line in f]
+		self.assertEqual([r["success"] for r in records], [True, False, True])
+
+	def test_bundles(self):
+		meta_sha1 = make_repo(self.config.meta_repo_root)
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertTrue(self.kit.isShallow())
+		bundle_dir = os.path.join(self.tmp.name, "bundles")
+		os.makedirs(bundle_dir)
+		self.module.options.bundle_out = bundle_dir
+		self.assertTrue(self.module.export_bundles())
+		self.assertEqual(sorted(os.listdir(bundle_dir)), ["core-kit-1.3-prime.bundle", "manifest.json", "meta-repo.bundle"])
+
+		# another system, with no access to the upstream repositories:
+		offline_root = os.path.join(self.tmp.name, "offline")
+		offline = SimpleNamespace(**vars(self.config))
+		offline.meta_repo_root = os.path.join(offline_root, "meta-repo")
+		offline.kits_root = os.path.join(offline_root, "kits")
+		offline.sync_base_url = "file:///nonexistent/{repo}.git"
+		module = self.new_module(offline)
+		module.options.bundle_in = bundle_dir
+		with mock.patch.object(GitHelper, "clone") as clone, mock.patch.object(GitHelper, "fetchCommit") as fetch_commit:
+			self.assertTrue(module.sync_meta_repo())
+			self.assertTrue(module.sync_kit("core-kit", offline.kits_root, "1.3-prime", "1.3-prime"))
+			clone.assert_not_called()
+			fetch_commit.assert_not_called()
+		self.assertEqual(GitHelper(None, offline.meta_repo_root).commitID, meta_sha1)
+		kit = GitHelper(None, os.path.join(offline.kits_root, "core-kit"))
+		self.assertEqual(kit.commitID, self.commits[0])
+		self.assertEqual(kit.reader.symbolic_head(), "refs/heads/1.3-prime")
+		self.assertTrue(kit.isShallow())
+		self.assertEqual(git(kit.root, "remote", "get-url", "origin"), "file:///nonexistent/core-kit.git")
+		self.assertTrue(module.kit_is_aligned("core-kit", "1.3-prime"))
+
+		# upstream moves on; the build host syncs and exports again, and the offline system follows:
+		make_repo(self.src, commits=3, branch="1.3-prime")
+		git(self.src, "push", "-q", self.bare, "1.3-prime")
+		new_sha1 = git(self.src, "rev-parse", "HEAD")
+		self.set_desired(new_sha1)
+		self.assertTrue(self.module.sync_kit("core-kit", self.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertTrue(self.module.export_bundles())
+		module = self.new_module(offline)
+		module.options.bundle_in = bundle_dir
+		self.assertTrue(module.sync_kit("core-kit", offline.kits_root, "1.3-prime", "1.3-prime"))
+		self.assertEqual(kit.commitID, new_sha1)
+		git(kit.root, "fsck", "--no-progress")
+
+		# a bundle that doesn't match what meta-repo specifies is refused:
+		self.set_desired(self.commits[1])
+		with mock.patch("ego.output.Output.error"):
+			with self.assertRaises(SystemExit) as cm:
+				module.sync_kit("core-kit", offline.kits_root, "1.3-prime", "1.3-prime")
+		self.assertEqual(cm.exception.code, 2)
+
+
+class ReposConfTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.repos_conf = os.path.join(self.tmp.name, "repos.conf")
+		self.kits = {"core-kit": "1.3-prime", "xorg-kit": "1.3-prime", "nokit": "master"}
+		self.config = SimpleNamespace(
+			ego_mods_info={"sync": {}},
+			kit_info_metadata={"kit_order": ["core-kit", "xorg-kit", "nokit"]},
+			repos_conf_path=self.repos_conf,
+			unprefixed_kits_root="/var/git/meta-repo/kits",
+			root_path=self.tmp.name,
+		)
+		self.module = load_ego_module("sync").Module("sync", self.config)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def update(self):
+		self.config.kit_table = ResolvedKitTable(self.kits, self.config.kit_info_metadata, {}, "1.3")
+		logged = []
+		with mock.patch("ego.output.Output.log", side_effect=logged.append):
+			self.module.update_repos_conf()
+		return logged[-1]
+
+	def test_only_changed_entries_are_written(self):
+		self.assertIn("3 added, 0 changed, 0 removed, 0 unchanged", self.update())
+		self.assertEqual(sorted(os.listdir(self.repos_conf)), ["ego-core-kit", "ego-nokit", "ego-xorg-kit"])
+		with open(os.path.join(self.repos_conf, "ego-core-kit")) as f:
+			self.assertTrue(f.read().startswith("[DEFAULT]\nmain-repo = core-kit\n"))
+		inodes = {name: os.stat(os.path.join(self.repos_conf, name)).st_ino for name in os.listdir(self.repos_conf)}
+
+		self.assertIn("0 added, 0 changed, 0 removed, 3 unchanged", self.update())
+		for name, inode in inodes.items():
+			self.assertEqual(os.stat(os.path.join(self.repos_conf, name)).st_ino, inode)
+
+		with open(os.path.join(self.repos_conf, "ego-nokit"), "a") as f:
+			f.write("# local change\n")
+		self.kits["xorg-kit"] = "skip"
+		self.assertIn("0 added, 1 changed, 1 removed, 1 unchanged", self.update())
+		self.assertEqual(sorted(os.listdir(self.repos_conf)), ["ego-core-kit", "ego-nokit"])
+		self.assertEqual(os.stat(os.path.join(self.repos_conf, "ego-core-kit")).st_ino, inodes["ego-core-kit"])
+		self.assertEqual(oct(os.stat(os.path.join(self.repos_conf, "ego-nokit")).st_mode & 0o777), "0o644")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import unittest
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cmdtools import run, timings
+from ego.workers import ForkedWorkerPool
+
+
+class ForkedWorkerPoolTest(unittest.TestCase):
+	def test_exit_status(self):
+		pool = ForkedWorkerPool(jobs=2, outfile=StringIO())
+		pool.submit("good", lambda: True)
+		pool.submit("bad", lambda: False)
+		pool.submit("fatal", lambda: sys.exit(3))
+		results = pool.run()
+		self.assertEqual(list(results.keys()), ["good", "bad", "fatal"])
+		self.assertEqual(os.WEXITSTATUS(results["good"]), 0)
+		self.assertEqual(os.WEXITSTATUS(results["bad"]), 1)
+		self.assertEqual(os.WEXITSTATUS(results["fatal"]), 3)
+
+	def test_on_complete(self):
+		completed = []
+		pool = ForkedWorkerPool(jobs=2, outfile=StringIO(), on_complete=lambda label, status: completed.append((label, status)))
+		pool.submit("slow", lambda: time.sleep(0.3) or True)
+		pool.submit("fast", lambda: False)
+		pool.run()
+		self.assertEqual(completed, [("fast", 256), ("slow", 0)])
+
+	def test_labelled_output(self):
+		def job(name):
+			def fn():
+				print("hello from %s" % name)
+				os.system("echo subprocess %s" % name)
+				return True
+
+			return fn
+
+		out = StringIO()
+		pool = ForkedWorkerPool(jobs=3, outfile=out)
+		for name in ["core-kit", "xorg-kit", "net-kit"]:
+			pool.submit(name, job(name))
+		pool.run()
+		lines = out.getvalue().splitlines()
+		self.assertEqual(len(lines), 6)
+		for name in ["core-kit", "xorg-kit", "net-kit"]:
+			mine = [line for line in lines if line.split("|")[0].strip().endswith(name)]
+			self.assertEqual(len(mine), 2)
+			self.assertTrue(mine[0].endswith("hello from %s" % name))
+			self.assertTrue(mine[1].endswith("subprocess %s" % name))
+
+	def test_concurrency(self):
+		# each job waits for all the others to start, which only succeeds if they all run at the same time:
+		barrier = multiprocessing.Barrier(4)
+
+		def job():
+			try:
+				barrier.wait(timeout=30)
+			except threading.BrokenBarrierError:
+				return False
+			return True
+
+		pool = ForkedWorkerPool(jobs=4, outfile=StringIO())
+		for i in range(4):
+			pool.submit("job%s" % i, job)
+		results = pool.run()
+		self.assertEqual([os.WEXITSTATUS(status) for status in results.values()], [0, 0, 0, 0])
+
+	def test_timings_from_workers(self):
+		def job(name):
+			def fn():
+				with timings.phase("kit", kit=name):
+					return run("true") == 0
+
+			return fn
+
+		mark = timings.mark()
+		for label_output in [True, False]:
+			pool = ForkedWorkerPool(jobs=2, label_output=label_output, outfile=StringIO())
+			for name in ["core-kit", "xorg-kit"]:
+				pool.submit(name, job(name))
+			pool.run()
+		records = timings.records[mark:]
+		commands = [r for r in records if r["type"] == "command"]
+		self.assertEqual(len(commands), 4)
+		self.assertEqual(sorted(r["kit"] for r in commands), ["core-kit", "core-kit", "xorg-kit", "xorg-kit"])
+		self.assertTrue(all(r["phase"] == "kit" and r["command"] == "true" for r in commands))
+		self.assertEqual(len([r for r in records if r["type"] == "phase"]), 4)
+
+
+if __name__ == "__main__":
+	unittest.main()